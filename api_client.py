@@ -0,0 +1,81 @@
+import os
+import threading
+
+import requests
+
+import http_client
+from forecast_models import model_from_payload
+from weather_cache import TTLCache
+
+# Base URL of a shared forecast_api process (e.g. http://127.0.0.1:8600). When set, the
+# dashboard reads forecasts from it instead of keeping its own forecast cache.
+API_URL = os.environ.get("WEATHER_API_URL", "").rstrip("/")
+
+# How long the last copy of each response is kept for revalidation
+RESPONSE_TTL = 24 * 60 * 60
+
+FORECAST_KINDS = ("current", "hourly", "daily")
+
+
+# Function to turn a /forecast response back into the models the sections read
+def parse_forecast(payload, version=None):
+    utc_offset_seconds = payload.get("utc_offset_seconds", 0)
+    data = {key: value for key, value in payload.items() if key not in FORECAST_KINDS}
+    for kind in FORECAST_KINDS:
+        if kind in payload:
+            data[kind] = model_from_payload(kind, payload[kind], utc_offset_seconds, version)
+    return data
+
+
+class ForecastAPIClient:
+    """Reads forecasts from forecast_api, revalidating its last copy of each response with its ETag."""
+
+    def __init__(self, base_url, max_entries=1024):
+        self.base_url = base_url
+        self._responses = TTLCache(max_entries=max_entries)  # request params -> (etag, data)
+        # The API already retries its own upstreams, so its error responses aren't retried again here
+        self._session = http_client.create_session(retry=http_client.CONNECT_RETRY)
+
+    def _get(self, params, etag=None):
+        headers = {"If-None-Match": etag} if etag else None
+        return http_client.get(f"{self.base_url}/forecast", params=params, headers=headers, via=self._session)
+
+    def forecast(self, lat, lon, unit='fahrenheit', current=(), hourly=(), daily=()):
+        params = {"lat": lat, "lon": lon, "unit": unit}
+        for kind, names in (("current", current), ("hourly", hourly), ("daily", daily)):
+            if names:
+                params[kind] = ",".join(names)
+        key = tuple(params.items())
+        cached = self._responses.get(key, None)
+
+        try:
+            response = self._get(params, cached[0] if cached is not None else None)
+            if response.status_code == 304 and cached is None:
+                # Nothing left to revalidate against (the copy was evicted), so ask for the whole body
+                response = self._get(params)
+        except requests.RequestException:
+            return cached[1] if cached is not None else None
+        if response.status_code == 304 and cached is not None:
+            # Unchanged: hand back the same models, so figures built from them stay cached
+            return cached[1]
+        if response.status_code != 200:
+            # The API is failing: keep showing the last good copy, if there is one
+            return cached[1] if cached is not None else None
+
+        etag = response.headers.get("ETag")
+        data = parse_forecast(http_client.decode_json(response), version=(self.base_url, key, etag))
+        self._responses.set(key, (etag, data), RESPONSE_TTL)
+        return data
+
+
+_client = None
+_init_lock = threading.Lock()
+
+
+# Function to get the process-wide client for API_URL
+def get_api_client():
+    global _client
+    with _init_lock:
+        if _client is None or _client.base_url != API_URL:
+            _client = ForecastAPIClient(API_URL)
+        return _client
@@ -0,0 +1,267 @@
+"""
+Offline benchmarks for the weather dashboard, run against benchmarks.stub_upstream.
+
+    python -m benchmarks.bench_dashboard --latency 0.05 --sessions 16 --output bench.json
+
+Measures main() render time under Streamlit's AppTest (cold and warm caches),
+upstream calls per rerun, cold vs warm forecast latency and data-path throughput
+under concurrent sessions. Results are printed (or written) as JSON so they can
+be compared between releases.
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_FILE = os.path.join(ROOT, "weather_dashboard.py")
+ALL_SECTIONS = ["Current Weather", "Hourly Graph", "Sunrise/Sunset", "7-Day Forecast"]
+BENCH_CITIES = ["New York", "London", "Paris", "Mumbai", "Tokyo", "Sydney", "Denver"]
+
+
+# Function to summarise a list of durations (seconds) in milliseconds
+def summarize(samples):
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+    return {
+        "n": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+# Function to get the p-th percentile of already sorted samples (nearest-rank)
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    rank = max(1, min(len(ordered), round(p / 100 * len(ordered) + 0.5)))
+    return ordered[rank - 1]
+
+
+# Function to empty every process-wide cache, as after a restart
+def reset_caches():
+    import geocoding
+    from weather_cache import forecast_cache, stale_forecast_cache, location_cache, figure_cache
+
+    forecast_cache.clear()
+    stale_forecast_cache.clear()
+    location_cache.clear()
+    figure_cache.clear()
+    with geocoding._init_lock:
+        geocoding._geocoder = None
+        if geocoding._store is not None:
+            path = geocoding._store.path
+            geocoding._store.close()
+            geocoding._store = None
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+
+# Function to lift Nominatim's 1 request/s limit, which the stub doesn't need, so cold lookups
+# measure the app instead of queueing behind the limiter until they time out
+def use_unthrottled_geocoder(burst):
+    import geocoding
+
+    scheduler = geocoding.GeocodeScheduler(
+        geocoding.get_geocode_store(), geocoding.get_gazetteer(),
+        limiter=geocoding.TokenBucket(rate=1000.0, burst=burst),
+    )
+    with geocoding._init_lock:
+        geocoding._geocoder = scheduler
+
+
+# Function to render the dashboard once for a new session and time it
+def new_session(email="bench@example.com", sections=ALL_SECTIONS):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_FILE, default_timeout=60)
+    at.query_params["email"] = email
+    at.session_state["sections"] = list(sections)
+    start = time.perf_counter()
+    at.run()
+    elapsed = time.perf_counter() - start
+    if at.exception:
+        raise RuntimeError(f"Dashboard raised: {at.exception[0].value}")
+    return at, elapsed
+
+
+# Function to time one rerun of an existing session
+def rerun(at):
+    start = time.perf_counter()
+    at.run()
+    elapsed = time.perf_counter() - start
+    if at.exception:
+        raise RuntimeError(f"Dashboard raised: {at.exception[0].value}")
+    return elapsed
+
+
+def bench_render(stub, runs):
+    cold, warm, reruns = [], [], []
+    cold_calls, warm_calls, rerun_calls = [], [], []
+
+    for _ in range(runs):
+        reset_caches()
+        stub.reset()
+        at, elapsed = new_session()
+        cold.append(elapsed)
+        cold_calls.append(stub.total_calls())
+
+        # A second visitor arriving while the process caches are warm
+        stub.reset()
+        at, elapsed = new_session()
+        warm.append(elapsed)
+        warm_calls.append(stub.total_calls())
+
+        # The same visitor clicking a widget
+        stub.reset()
+        reruns.append(rerun(at))
+        rerun_calls.append(stub.total_calls())
+
+    return {
+        "cold_session": summarize(cold),
+        "warm_session": summarize(warm),
+        "rerun": summarize(reruns),
+        "upstream_calls_per_run": {
+            "cold_session": statistics.fmean(cold_calls),
+            "warm_session": statistics.fmean(warm_calls),
+            "rerun": statistics.fmean(rerun_calls),
+        },
+    }
+
+
+def bench_forecast_cache(stub, runs):
+    from weather_core import cached_forecast, plan_data
+
+    variables = plan_data(ALL_SECTIONS).variables()
+    cold, warm = [], []
+    for _ in range(runs):
+        reset_caches()
+        start = time.perf_counter()
+        cached_forecast(40.7127, -74.0060, "fahrenheit", **variables)
+        cold.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        cached_forecast(40.7127, -74.0060, "fahrenheit", **variables)
+        warm.append(time.perf_counter() - start)
+    return {"cold": summarize(cold), "warm": summarize(warm)}
+
+
+def bench_concurrency(stub, sessions, requests_per_session):
+    import weather_dashboard as app
+    from weather_core import cached_forecast, plan_data
+
+    reset_caches()
+    stub.reset()
+    use_unthrottled_geocoder(sessions)
+    variables = plan_data(ALL_SECTIONS).variables()
+    latencies = []
+    lookup_failures = 0
+    errors = collections.Counter()
+    lock = threading.Lock()
+    barrier = threading.Barrier(sessions)
+
+    def session(index):
+        nonlocal lookup_failures
+        barrier.wait()
+        for i in range(requests_per_session):
+            city = BENCH_CITIES[(index + i) % len(BENCH_CITIES)]
+            unit = "celsius" if (index + i) % 2 else "fahrenheit"
+            start = time.perf_counter()
+            try:
+                lat, lon, _ = app.get_coordinates(city)
+                if lat is None:
+                    with lock:
+                        lookup_failures += 1
+                    continue
+                cached_forecast(lat, lon, unit, **variables)
+            except Exception as e:
+                # Counted rather than left to kill the thread, which would quietly shrink the sample
+                with lock:
+                    errors[f"{type(e).__name__}: {e}"] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    return {
+        "sessions": sessions,
+        "requests": len(latencies),
+        "lookup_failures": lookup_failures,
+        "errors": sum(errors.values()),
+        "error_kinds": dict(errors.most_common(5)),
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 1),
+        "latency": summarize(latencies),
+        "upstream_calls": dict(stub.calls),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated upstream latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream calls answered with 503")
+    parser.add_argument("--runs", type=int, default=5, help="repetitions of each render/cache measurement")
+    parser.add_argument("--sessions", type=int, default=16, help="concurrent simulated sessions")
+    parser.add_argument("--requests", type=int, default=20, help="requests per concurrent session")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    output_path = os.path.abspath(args.output) if args.output else None
+
+    # Keep the benchmark's databases away from the real ones
+    workdir = tempfile.mkdtemp(prefix="weather-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+    from benchmarks.stub_upstream import UpstreamStub, install_app
+
+    stub = UpstreamStub(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    uninstall = install_app(stub)
+    try:
+        results = {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "latency_s": args.latency,
+                "jitter_s": args.jitter,
+                "error_rate": args.error_rate,
+                "runs": args.runs,
+            },
+            "render": bench_render(stub, args.runs),
+            "forecast_cache": bench_forecast_cache(stub, args.runs),
+            "concurrency": bench_concurrency(stub, args.sessions, args.requests),
+        }
+    finally:
+        uninstall()
+
+    output = json.dumps(results, indent=2)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,442 @@
+"""
+Load/soak test for the weather dashboard, run against benchmarks.stub_upstream.
+
+    python -m benchmarks.load_dashboard --profile fixed --sessions 20 --rate 0.2 --duration 60
+    python -m benchmarks.load_dashboard --profile ramp --sessions 60 --ramp 120 --duration 180 --workers 2
+
+Simulated users log in through the ?email= query parameter, then search for cities,
+toggle sections, add and remove favorites and sit through refresh ticks, each at a
+fixed rate (--rate actions per second per session). The "fixed" profile starts every
+session at once; "ramp" adds them evenly over --ramp seconds, and the results are
+broken down into --stages time windows so you can see where reruns start to slow down.
+
+Reported, as JSON:
+  - rerun latency (time spent running the script) and response latency (measured from
+    when the action was due, so time spent queueing is counted), p50/p95/p99
+  - memory per logged-in session and its growth over the soak (tracemalloc)
+  - storage contention: time spent in each user/geocode/history store call, time spent
+    waiting for each store's lock, and SQLite errors
+  - upstream calls made by the app
+
+tracemalloc slows Python down several times over, which inflates the latencies; use
+--no-tracemalloc for latency runs and compare runs made with the same setting.
+
+Streamlit's AppTest swaps process-wide runtime state on every run, so within one
+process the script runs one at a time; sessions wait their turn just as they queue for
+the GIL in a real server. --workers runs several such processes side by side sharing
+the same databases, like a multi-worker deployment.
+"""
+import argparse
+import collections
+import functools
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from benchmarks.bench_dashboard import ALL_SECTIONS, APP_FILE, BENCH_CITIES, ROOT, summarize, use_unthrottled_geocoder
+
+DASHBOARD_SECTIONS = ALL_SECTIONS + ["Favorites Overview"]
+
+# A city the stub doesn't know, so the "not found" path is exercised too
+SEARCH_CITIES = BENCH_CITIES + ["Atlantis"]
+
+# Relative weights of the actions a session picks between
+ACTIONS = {"search": 4, "toggle_sections": 2, "add_favorite": 1, "remove_favorite": 1, "tick": 4}
+
+# Stores whose calls and lock waits are timed: name -> (module, class, getter, methods)
+STORE_CALLS = {
+    "user_store": ("storage", "UserStore", "get_user_store",
+                   ("get_favorites", "add_favorite", "remove_favorite", "get_settings", "save_settings")),
+    "geocode_store": ("geocoding", "GeocodeStore", "get_geocode_store", ("get", "put", "flush_searches")),
+    "history_store": ("history", "HistoryStore", "get_history_store", ("record", "range")),
+}
+
+RUN_TIMEOUT = 60
+
+
+# Function to find a widget by its label
+def widget(elements, label):
+    for element in elements:
+        if element.label == label:
+            return element
+    raise LookupError(f"No widget labelled {label!r}")
+
+
+def search(at, rng):
+    widget(at.sidebar.text_input, "Enter city name").set_value(rng.choice(SEARCH_CITIES))
+    at.run()
+
+
+def toggle_sections(at, rng):
+    sections = rng.sample(DASHBOARD_SECTIONS, rng.randint(1, len(DASHBOARD_SECTIONS)))
+    widget(at.sidebar.multiselect, "📊 Select Sections to Display:").set_value(sections)
+    at.run()
+
+
+def add_favorite(at, rng):
+    widget(at.sidebar.button, "⭐ Add to Favorites").click()
+    at.run()
+
+
+def remove_favorite(at, rng):
+    try:
+        widget(at.sidebar.button, "🗑️ Remove Favorite").click()
+    except LookupError:
+        pass  # No favorites yet; the rerun still counts, like a tick
+    at.run()
+
+
+# A refresh tick: the fragment's run_every reruns only the sections, so this whole-script
+# rerun is an upper bound on its cost
+def tick(at, rng):
+    at.run()
+
+
+ACTION_STEPS = {"search": search, "toggle_sections": toggle_sections, "add_favorite": add_favorite,
+                "remove_favorite": remove_favorite, "tick": tick}
+
+
+class TimedLock:
+    """Wraps a store's lock and records how long each acquire waited for it."""
+
+    def __init__(self, lock, waits):
+        self._lock = lock
+        self._waits = waits
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        self._waits.append(time.perf_counter() - start)
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+        return False
+
+
+class LoadRun:
+    """The shared state of one worker process: its sessions' samples, errors and storage timings."""
+
+    def __init__(self, sessions, seed):
+        self.sessions = sessions  # [(global index, start offset)]
+        self.seed = seed
+        self.runner_lock = threading.Lock()  # one AppTest run at a time, see the module docstring
+        self.lock = threading.Lock()
+        self.samples = []  # (due offset, action, rerun seconds, response seconds)
+        self.errors = collections.Counter()
+        self.logged_in = 0
+        self.apps = []
+        self.store_calls = collections.defaultdict(list)
+        self.lock_waits = collections.defaultdict(list)
+        self.storage_errors = 0
+        self.memory = {}
+        self.t0 = None
+
+    def instrument_storage(self):
+        import importlib
+
+        for store_name, (module_name, class_name, getter, methods) in STORE_CALLS.items():
+            module = importlib.import_module(module_name)
+            cls = getattr(module, class_name)
+            for method in methods:
+                setattr(cls, method, self._timed(getattr(cls, method), f"{store_name}.{method}"))
+            store = getattr(module, getter)()
+            store._lock = TimedLock(store._lock, self.lock_waits[store_name])
+
+    def _timed(self, method, name):
+        samples = self.store_calls[name]
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except sqlite3.OperationalError:
+                with self.lock:
+                    self.storage_errors += 1
+                raise
+            finally:
+                samples.append(time.perf_counter() - start)
+
+        return wrapper
+
+    def perform(self, at, action, step, due):
+        with self.runner_lock:
+            started = time.perf_counter()
+            try:
+                step()
+                error = str(at.exception[0].value) if at.exception else None
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            finished = time.perf_counter()
+        with self.lock:
+            if error:
+                self.errors[f"{action}: {error}"[:200]] += 1
+            self.samples.append((due - self.t0, action, finished - started, finished - due))
+
+    def session(self, index, start_offset, interval, end):
+        from streamlit.testing.v1 import AppTest
+
+        rng = random.Random(self.seed * 100003 + index)
+        names, weights = list(ACTIONS), list(ACTIONS.values())
+        due = self.t0 + start_offset
+        sleep_until(due)
+        at = AppTest.from_file(APP_FILE, default_timeout=RUN_TIMEOUT)
+        at.query_params["email"] = f"load{index}@example.com"
+        with self.lock:
+            self.apps.append(at)  # Kept until the end, so the memory they hold is measured
+        self.perform(at, "login", at.run, due)
+        with self.lock:
+            self.logged_in += 1
+            if self.logged_in == len(self.sessions) and tracemalloc.is_tracing():
+                self.memory["all_logged_in"] = traced_memory()
+        while True:
+            due += interval
+            if due >= end:
+                break
+            sleep_until(due)
+            action = rng.choices(names, weights)[0]
+            self.perform(at, action, functools.partial(ACTION_STEPS[action], at, rng), due)
+
+
+# Function to sleep until a time.perf_counter() instant (returns straight away if it's past)
+def sleep_until(instant):
+    delay = instant - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+
+
+# Function to measure the bytes currently allocated, after a full collection
+def traced_memory():
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+# Function to run one worker process's share of the sessions and return its raw measurements
+def run_worker(config, sessions, barrier=None):
+    os.chdir(config["workdir"])
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    from benchmarks.stub_upstream import UpstreamStub, install_app
+
+    stub = UpstreamStub(latency=config["latency"], jitter=config["jitter"], error_rate=config["error_rate"],
+                        seed=config["seed"])
+    uninstall = install_app(stub)
+    run = LoadRun(sessions, config["seed"])
+    try:
+        from streamlit.testing.v1 import AppTest
+
+        use_unthrottled_geocoder(max(1, len(sessions)))
+        run.instrument_storage()
+        if config["tracemalloc"]:
+            tracemalloc.start()
+
+        # One throwaway session loads pandas/plotly and warms the process caches, as in a server
+        # that's been up a while; the baseline is taken after it
+        warmup = AppTest.from_file(APP_FILE, default_timeout=RUN_TIMEOUT)
+        warmup.query_params["email"] = "warmup@example.com"
+        warmup.session_state["sections"] = list(DASHBOARD_SECTIONS)
+        warmup.run()
+        del warmup
+        if config["tracemalloc"]:
+            run.memory["baseline"] = traced_memory()
+        for samples in list(run.store_calls.values()) + list(run.lock_waits.values()):
+            samples.clear()
+        stub.reset()
+
+        if barrier is not None:
+            barrier.wait()
+        run.t0 = time.perf_counter()
+        end = run.t0 + config["duration"]
+        threads = [threading.Thread(target=run.session, args=(index, offset, 1 / config["rate"], end), daemon=True)
+                   for index, offset in sessions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if config["tracemalloc"]:
+            run.memory["end"] = traced_memory()
+            run.memory["peak"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    finally:
+        uninstall()
+
+    return {
+        "sessions": len(sessions),
+        "samples": run.samples,
+        "errors": dict(run.errors),
+        "store_calls": {name: list(samples) for name, samples in run.store_calls.items()},
+        "lock_waits": {name: list(samples) for name, samples in run.lock_waits.items()},
+        "storage_errors": run.storage_errors,
+        "memory": run.memory,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "upstream_calls": dict(stub.calls),
+    }
+
+
+# Function to run a worker in its own process and hand back its result through a queue
+def _worker_process(config, sessions, barrier, results):
+    try:
+        results.put(run_worker(config, sessions, barrier))
+    except BaseException as e:
+        barrier.abort()
+        results.put({"failed": f"{type(e).__name__}: {e}"})
+
+
+# Function to work out when each session starts: all at once, or spread evenly over the ramp
+def session_offsets(profile, sessions, rate, ramp):
+    if profile == "ramp":
+        return [index * ramp / sessions for index in range(sessions)]
+    # Spread over one interval so the sessions don't act in lockstep
+    return [index / rate / sessions for index in range(sessions)]
+
+
+# Function to summarise each time window of the run, with how many sessions had started by its end
+def summarize_stages(samples, offsets, duration, stages):
+    width = duration / stages
+    windows = [[] for _ in range(stages)]
+    for sample in samples:
+        windows[min(stages - 1, int(sample[0] // width))].append(sample)
+    return [{
+        "from_s": round(i * width, 1),
+        "to_s": round((i + 1) * width, 1),
+        "sessions": sum(offset < (i + 1) * width for offset in offsets),
+        "actions": len(window),
+        "rerun": summarize([sample[2] for sample in window]),
+        "response": summarize([sample[3] for sample in window]),
+    } for i, window in enumerate(windows)]
+
+
+# Function to merge the workers' measurements into the report
+def build_report(config, offsets, results):
+    samples = [sample for result in results for sample in result["samples"]]
+    errors = collections.Counter()
+    store_calls, lock_waits = collections.defaultdict(list), collections.defaultdict(list)
+    upstream = collections.Counter()
+    for result in results:
+        errors.update(result["errors"])
+        upstream.update(result["upstream_calls"])
+        for name, values in result["store_calls"].items():
+            store_calls[name] += values
+        for name, values in result["lock_waits"].items():
+            lock_waits[name] += values
+
+    by_action = collections.defaultdict(list)
+    for sample in samples:
+        by_action[sample[1]].append(sample)
+
+    memory = {"max_rss_mb": round(max(result["max_rss_kb"] for result in results) / 1024, 1)}
+    traced = [result for result in results if "baseline" in result["memory"]]
+    if traced:
+        per_session = [(result["memory"]["all_logged_in"] - result["memory"]["baseline"]) / result["sessions"]
+                       for result in traced if "all_logged_in" in result["memory"]]
+        growth = [(result["memory"]["end"] - result["memory"]["all_logged_in"]) / result["sessions"]
+                  for result in traced if "all_logged_in" in result["memory"]]
+        memory.update({
+            "baseline_mb": round(sum(result["memory"]["baseline"] for result in traced) / len(traced) / 2**20, 1),
+            "peak_mb": round(max(result["memory"]["peak"] for result in traced) / 2**20, 1),
+            # Held per logged-in session, then added per session over the rest of the soak
+            "per_session_kb": round(sum(per_session) / len(per_session) / 1024, 1) if per_session else None,
+            "soak_growth_per_session_kb": round(sum(growth) / len(growth) / 1024, 1) if growth else None,
+        })
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            **{key: config[key] for key in ("profile", "sessions", "rate", "duration", "ramp", "workers",
+                                            "latency", "jitter", "error_rate", "seed")},
+        },
+        "actions": len(samples),
+        "throughput_rps": round(len(samples) / config["duration"], 2),
+        "offered_rps": round(config["sessions"] * config["rate"], 2),
+        "errors": sum(errors.values()),
+        "error_kinds": dict(errors.most_common(5)),
+        "rerun": summarize([sample[2] for sample in samples]),
+        "response": summarize([sample[3] for sample in samples]),
+        "by_action": {action: {"rerun": summarize([sample[2] for sample in values]),
+                               "response": summarize([sample[3] for sample in values])}
+                      for action, values in sorted(by_action.items())},
+        "stages": summarize_stages(samples, offsets, config["duration"], config["stages"]),
+        "memory": memory,
+        "storage": {
+            "calls": {name: summarize(values) for name, values in sorted(store_calls.items()) if values},
+            "lock_wait": {name: summarize(values) for name, values in sorted(lock_waits.items()) if values},
+            "errors": sum(result["storage_errors"] for result in results),
+        },
+        "upstream_calls": dict(upstream),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", choices=("fixed", "ramp"), default="fixed")
+    parser.add_argument("--sessions", type=int, default=20, help="simulated sessions (all of them, by the end of a ramp)")
+    parser.add_argument("--rate", type=float, default=0.2, help="actions per second per session")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds to run for")
+    parser.add_argument("--ramp", type=float, default=None, help="seconds to add every session over (ramp profile; default: half the duration)")
+    parser.add_argument("--stages", type=int, default=5, help="time windows the results are broken down into")
+    parser.add_argument("--workers", type=int, default=1, help="server processes sharing the sessions and databases")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated upstream latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream calls answered with 503")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-tracemalloc", dest="tracemalloc", action="store_false",
+                        help="skip the memory measurements, which slow Python down")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    config = dict(vars(args))
+    if config["ramp"] is None:
+        config["ramp"] = args.duration / 2 if args.profile == "ramp" else 0.0
+    output_path = os.path.abspath(args.output) if args.output else None
+
+    # Keep the run's databases away from the real ones; every worker shares this directory
+    config["workdir"] = tempfile.mkdtemp(prefix="weather-load-")
+    offsets = session_offsets(args.profile, args.sessions, args.rate, config["ramp"])
+    shares = [[(index, offsets[index]) for index in range(worker, args.sessions, args.workers)]
+              for worker in range(args.workers)]
+
+    if args.workers == 1:
+        results = [run_worker(config, shares[0])]
+    else:
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(args.workers)
+        queue = context.Queue()
+        processes = [context.Process(target=_worker_process, args=(config, share, barrier, queue))
+                     for share in shares]
+        for process in processes:
+            process.start()
+        results = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+        failed = [result["failed"] for result in results if "failed" in result]
+        if failed:
+            raise RuntimeError(f"Load worker failed: {failed[0]}")
+
+    report = build_report(config, offsets, results)
+    output = json.dumps(report, indent=2)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Offline stand-in for ipinfo.io, Nominatim and Open-Meteo.
+
+StubAdapter is a requests transport adapter that answers from generated payloads
+shaped like the real APIs, with configurable latency and error rate. Mount it on the
+app's sessions (see install_app) and the whole app runs without a network.
+"""
+import collections
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+
+# A handful of cities the stub knows about: name -> (lat, lon, display_name, utc_offset_seconds, timezone)
+CITIES = {
+    "new york": (40.7127, -74.0060, "City of New York, New York, United States", -4 * 3600, "America/New_York"),
+    "hoboken": (40.7440, -74.0324, "Hoboken, Hudson County, New Jersey, United States", -4 * 3600, "America/New_York"),
+    "london": (51.5074, -0.1278, "London, Greater London, England, United Kingdom", 3600, "Europe/London"),
+    "paris": (48.8535, 2.3484, "Paris, Île-de-France, France", 2 * 3600, "Europe/Paris"),
+    "mumbai": (19.0550, 72.8692, "Mumbai, Mumbai Suburban, Maharashtra, India", 19800, "Asia/Kolkata"),
+    "tokyo": (35.6769, 139.7639, "Tokyo, Japan", 9 * 3600, "Asia/Tokyo"),
+    "sydney": (-33.8698, 151.2083, "Sydney, New South Wales, Australia", 10 * 3600, "Australia/Sydney"),
+    "denver": (39.7392, -104.9849, "Denver, Colorado, United States", -6 * 3600, "America/Denver"),
+}
+
+WEATHER_CODES = [0, 1, 2, 3, 45, 51, 61, 63, 71, 80, 95]
+
+
+class UpstreamStub:
+    """Generates realistic API payloads and records every call it serves."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.bytes_sent = 0
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.bytes_sent = 0
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def handle(self, url):
+        # Returns (status_code, payload) for a GET of url
+        parts = urlsplit(url)
+        params = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        host = parts.hostname or ""
+
+        with self._lock:
+            self.calls[host] += 1
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+            failed = self.error_rate and self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if failed:
+            return 503, {"error": True, "reason": "Service temporarily unavailable (stub)"}
+
+        if "ipinfo" in host:
+            return 200, self.ipinfo(parts.path)
+        if "nominatim" in host:
+            return 200, self.nominatim(params.get("q", ""))
+        if "open-meteo" in host:
+            return self.forecast(params)
+        return 404, {"error": True, "reason": f"Unknown host {host}"}
+
+    def ipinfo(self, path):
+        lat, lon = CITIES["hoboken"][:2]
+        ip = path.strip("/").split("/")[0] if path.count("/") > 1 else "203.0.113.7"
+        return {"ip": ip, "city": "Hoboken", "region": "New Jersey", "country": "US", "loc": f"{lat},{lon}"}
+
+    def nominatim(self, query):
+        city = CITIES.get(" ".join(query.casefold().split()))
+        if city is None:
+            return []
+        lat, lon, display_name = city[:3]
+        name = display_name.split(",")[0]
+        return [{
+            "place_id": abs(hash(name)) % 10**8, "lat": str(lat), "lon": str(lon), "name": name,
+            "display_name": display_name, "class": "boundary", "type": "administrative", "addresstype": "city",
+        }]
+
+    def forecast(self, params):
+        if "," in params["latitude"]:
+            # Several comma-separated locations come back as a list, in request order
+            points = zip(params["latitude"].split(","), params["longitude"].split(","))
+            return 200, [self.forecast(dict(params, latitude=lat, longitude=lon))[1] for lat, lon in points]
+
+        lat, lon = float(params["latitude"]), float(params["longitude"])
+        offset, tz = 0, "GMT"
+        for city_lat, city_lon, _, city_offset, city_tz in CITIES.values():
+            if abs(city_lat - lat) < 0.1 and abs(city_lon - lon) < 0.1:
+                offset, tz = city_offset, city_tz
+        if params.get("timezone") != "auto":
+            offset, tz = 0, "GMT"
+
+        fahrenheit = params.get("temperature_unit") == "fahrenheit"
+        convert = (lambda c: round(c * 9 / 5 + 32, 1)) if fahrenheit else (lambda c: round(c, 1))
+        local_now = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=offset)
+        today = local_now.replace(hour=0, minute=0, second=0, microsecond=0)
+        base = 15 + 10 * math.cos(math.radians(lat))
+
+        payload = {
+            "latitude": round(lat, 4), "longitude": round(lon, 4), "generationtime_ms": 0.1,
+            "utc_offset_seconds": offset, "timezone": tz, "timezone_abbreviation": tz, "elevation": 10.0,
+        }
+        if params.get("current"):
+            current = {"time": local_now.replace(minute=local_now.minute // 15 * 15, second=0, microsecond=0).strftime("%Y-%m-%dT%H:%M"),
+                       "interval": 900}
+            values = {
+                "temperature_2m": convert(base + 3), "apparent_temperature": convert(base + 1),
+                "relative_humidity_2m": 60, "wind_speed_10m": 7.4, "weather_code": 2,
+            }
+            for name in params["current"].split(","):
+                current[name] = values.get(name, 0)
+            payload["current"] = current
+        if params.get("hourly"):
+            hours = [today + timedelta(hours=i) for i in range(7 * 24)]
+            hourly = {"time": [h.strftime("%Y-%m-%dT%H:%M") for h in hours]}
+            for name in params["hourly"].split(","):
+                if name == "temperature_2m":
+                    hourly[name] = [convert(base + 6 * math.sin((h.hour - 9) / 24 * 2 * math.pi)) for h in hours]
+                elif name == "relative_humidity_2m":
+                    hourly[name] = [int(65 - 20 * math.sin((h.hour - 9) / 24 * 2 * math.pi)) for h in hours]
+                else:
+                    hourly[name] = [0.0] * len(hours)
+            payload["hourly"] = hourly
+        if params.get("daily"):
+            days = [today + timedelta(days=i) for i in range(7)]
+            daily = {"time": [d.strftime("%Y-%m-%d") for d in days]}
+            for name in params["daily"].split(","):
+                if name == "sunrise":
+                    daily[name] = [d.replace(hour=6, minute=12).strftime("%Y-%m-%dT%H:%M") for d in days]
+                elif name == "sunset":
+                    daily[name] = [d.replace(hour=19, minute=34).strftime("%Y-%m-%dT%H:%M") for d in days]
+                elif name == "temperature_2m_max":
+                    daily[name] = [convert(base + 6 + i % 3) for i in range(7)]
+                elif name == "temperature_2m_min":
+                    daily[name] = [convert(base - 6 + i % 2) for i in range(7)]
+                elif name == "precipitation_probability_max":
+                    daily[name] = [(i * 17) % 100 for i in range(7)]
+                elif name in ("weathercode", "weather_code"):
+                    daily[name] = [WEATHER_CODES[(i * 3) % len(WEATHER_CODES)] for i in range(7)]
+                else:
+                    daily[name] = [0.0] * 7
+            payload["daily"] = daily
+        return 200, payload
+
+
+class StubAdapter(BaseAdapter):
+    """requests transport adapter that serves responses from an UpstreamStub."""
+
+    def __init__(self, stub):
+        super().__init__()
+        self.stub = stub
+
+    def send(self, request, **kwargs):
+        status, payload = self.stub.handle(request.url)
+        body = json.dumps(payload).encode()
+        with self.stub._lock:
+            self.stub.bytes_sent += len(body)
+
+        response = requests.Response()
+        response.status_code = status
+        response.reason = "OK" if status == 200 else "Error"
+        response.headers["Content-Type"] = "application/json"
+        response.headers["Content-Length"] = str(len(body))
+        response._content = body
+        response.url = request.url
+        response.request = request
+        response.encoding = "utf-8"
+        return response
+
+    def close(self):
+        pass
+
+
+# Function to route a requests session through the stub; returns a function that undoes it
+def install(session, stub):
+    previous = dict(session.adapters)
+    adapter = StubAdapter(stub)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    def uninstall():
+        session.adapters.clear()
+        session.adapters.update(previous)
+
+    return uninstall
+
+
+# Function to route every session the app calls upstream services through the stub
+def install_app(stub):
+    import geocoding
+    import http_client
+
+    undo = [install(session, stub) for session in (http_client.session, geocoding.nominatim_session)]
+
+    def uninstall():
+        for step in undo:
+            step()
+
+    return uninstall
@@ -0,0 +1,204 @@
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+import metrics
+from geocoding import get_geocoder, GeocodingError, RateLimited
+from refresher import get_warmer
+from weather_core import (SECTION_VARIABLES, forecast_dict, is_city, local_forecast, plan_data, warm_forecasts,
+                          watch_local_forecast)
+
+logger = logging.getLogger(__name__)
+
+# A small HTTP/JSON front for the fetch, cache and model layer, with no Streamlit involved.
+# Run one of these and point the dashboard workers at it (WEATHER_API_URL) so they all
+# share its warm cache instead of each keeping a cold one of their own:
+#
+#     python forecast_api.py --port 8600
+#     curl 'http://127.0.0.1:8600/forecast?city=Paris&sections=Current%20Weather&unit=celsius'
+
+API_HOST = os.environ.get("WEATHER_API_HOST", "127.0.0.1")
+API_PORT = int(os.environ.get("WEATHER_API_PORT", "8600"))
+
+# Bodies smaller than this aren't worth compressing
+MIN_GZIP_SIZE = 512
+
+UNITS = ("fahrenheit", "celsius")
+
+# Variables that can be asked for by name: the ones the dashboard sections use, which the
+# forecast models know how to parse
+KNOWN_VARIABLES = {
+    kind: {name for variables in SECTION_VARIABLES.values() for name in variables.get(kind, ())}
+    for kind in ("current", "hourly", "daily")
+}
+
+
+class APIError(Exception):
+    """A request the API can't answer, with the HTTP status to report."""
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+# Function to turn a comma-separated query parameter into a tuple of names
+def _names(query, name):
+    value = query.get(name, [""])[0]
+    return tuple(part.strip() for part in value.split(",") if part.strip())
+
+
+# Function to work out which variables a request asks for, by section name or explicitly by kind
+def _requested_variables(query):
+    sections = _names(query, "sections")
+    unknown = [section for section in sections if section not in SECTION_VARIABLES]
+    if unknown:
+        raise APIError(400, f"Unknown sections: {', '.join(unknown)}")
+    variables = plan_data(sections).variables()
+    for kind in variables:
+        names = _names(query, kind)
+        unknown = [name for name in names if name not in KNOWN_VARIABLES[kind]]
+        if unknown:
+            raise APIError(400, f"Unknown {kind} variables: {', '.join(unknown)}")
+        variables[kind] = tuple(dict.fromkeys(variables[kind] + names))
+    if not any(variables.values()):
+        raise APIError(400, "Ask for some sections, or current/hourly/daily variables")
+    return variables
+
+
+# Function to find the coordinates a request is about, from lat/lon or by geocoding the city
+def _locate(query):
+    if "lat" in query and "lon" in query:
+        try:
+            return float(query["lat"][0]), float(query["lon"][0]), None
+        except ValueError:
+            raise APIError(400, "lat and lon must be numbers")
+
+    city = query.get("city", [""])[0].strip()
+    if not city:
+        raise APIError(400, "Pass city, or lat and lon")
+    try:
+        location = get_geocoder().resolve(city)
+    except RateLimited:
+        raise APIError(503, "The geocoding service is busy", {"Retry-After": "1"})
+    except (GeocodingError, requests.RequestException) as e:
+        raise APIError(502, f"Geocoding failed: {e}")
+    if location is None or not is_city(location, city):
+        raise APIError(404, f"City '{city}' not found")
+    return float(location["lat"]), float(location["lon"]), location["display_name"]
+
+
+# Function to answer GET /forecast with the forecast as a JSON-ready dict
+@metrics.instrument("api.forecast")
+def forecast_response(query):
+    unit = query.get("unit", ["fahrenheit"])[0].lower()
+    if unit not in UNITS:
+        raise APIError(400, f"unit must be one of {', '.join(UNITS)}")
+    variables = _requested_variables(query)
+    lat, lon, address = _locate(query)
+
+    # Served from this process's own cache, never through WEATHER_API_URL (which may point
+    # back at this server), and kept fresh in the background like the dashboard's own reads
+    watch_local_forecast(lat, lon, **variables)
+    data = local_forecast(lat, lon, unit, **variables)
+    if data is None:
+        raise APIError(502, "Failed to retrieve forecast data")
+
+    response = {"latitude": lat, "longitude": lon, "unit": unit}
+    if address is not None:
+        response["address"] = address
+    response.update(forecast_dict(data))
+    return response
+
+
+class _ForecastHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the dashboard's pooled session reuses its connections
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        try:
+            if url.path != "/forecast":
+                raise APIError(404, "Not found")
+            payload = forecast_response(parse_qs(url.query))
+        except APIError as e:
+            self._send_json(e.status, {"error": e.message}, e.headers)
+            return
+        except Exception:
+            logger.exception("Answering %s failed", self.path)
+            self._send_json(500, {"error": "Internal server error"})
+            return
+        self._send_json(200, payload)
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, separators=(",", ":")).encode()
+        # Weak, because the same ETag is given to the compressed and plain forms of a body
+        etag = f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        if status == 200 and etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        encoding = None
+        if len(body) >= MIN_GZIP_SIZE and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=5)
+            encoding = "gzip"
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Vary", "Accept-Encoding")
+        if status == 200:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Function to serve the API in a background thread; returns the server (its port may be 0 to pick one)
+def start_api_server(host=API_HOST, port=API_PORT):
+    server = ThreadingHTTPServer((host, port), _ForecastHandler)
+    threading.Thread(target=server.serve_forever, name="forecast-api", daemon=True).start()
+    return server
+
+
+# Function to run the API as its own process, with the cache warmer and metrics
+def main():
+    parser = argparse.ArgumentParser(description="Serve forecasts as JSON over HTTP.")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    args = parser.parse_args()
+
+    metrics.start_metrics_server()
+    get_warmer(warm_forecasts).start()
+    server = start_api_server(args.host, args.port)
+    print(f"Serving forecasts on http://{args.host}:{server.server_port}/forecast")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
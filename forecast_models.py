@@ -0,0 +1,275 @@
+import numpy as np
+
+# Forecast objects live in this imported module (not the re-executed dashboard
+# script) so instances held in the shared caches stay valid across reruns.
+# Each one is parsed once from the API response and then only read, so the same
+# instance is shared by every session showing that location.
+
+# WMO weather interpretation codes used by Open-Meteo
+WEATHER_CODES = {
+    0: "Clear sky ☀️",
+    1: "Mainly clear 🌤️",
+    2: "Partly cloudy ⛅",
+    3: "Overcast ☁️",
+    45: "Fog 🌫️",
+    48: "Depositing rime fog 🌫️",
+    51: "Light drizzle 🌦️",
+    53: "Moderate drizzle 🌧️",
+    55: "Dense drizzle 🌧️",
+    61: "Slight rain 🌦️",
+    63: "Moderate rain 🌧️",
+    65: "Heavy rain 🌧️",
+    71: "Slight snow fall ❄️",
+    73: "Moderate snow fall ❄️",
+    75: "Heavy snow fall ❄️",
+    80: "Slight rain showers 🌦️",
+    81: "Moderate rain showers 🌧️",
+    82: "Violent rain showers ⛈️",
+    95: "Thunderstorm ⛈️",
+    96: "Thunderstorm with slight hail ⛈️",
+    99: "Thunderstorm with heavy hail ⛈️",
+}
+
+# Lookup table indexed by code (0-99); the last slot is for missing or unknown codes
+WEATHER_CODE_LABELS = np.array([WEATHER_CODES.get(code) for code in range(100)] + [None], dtype=object)
+WEATHER_CODE_LABELS.flags.writeable = False
+
+
+# Function to turn an array of weather codes into their labels in one vectorized lookup
+def weather_labels(codes):
+    codes = np.asarray(codes)
+    return WEATHER_CODE_LABELS[np.where((codes >= 0) & (codes < 100), codes, 100)]
+
+
+# Forecasts are fetched and cached in Open-Meteo's default units (celsius and km/h) whatever
+# unit a session shows, and converted when they are read. Wind speeds are shown in mph.
+MPH_PER_KMH = 1 / 1.609344
+
+
+# Function to convert a value or array (None stays None) with a linear formula, rounded to one decimal
+def _convert(values, scale, offset=0.0):
+    if values is None:
+        return None
+    if isinstance(values, np.ndarray):
+        # One vectorized pass over the whole series; the result is read-only like its source
+        converted = np.round(values * np.float32(scale) + np.float32(offset), 1).astype(values.dtype)
+        converted.flags.writeable = False
+        return converted
+    return round(values * scale + offset, 1)
+
+
+# Function to convert celsius temperatures to the display unit
+def convert_temperature(values, unit):
+    if unit != "fahrenheit":
+        return values
+    return _convert(values, 9 / 5, 32)
+
+
+# Function to convert km/h wind speeds to the display unit (mph)
+def convert_wind_speed(values):
+    return _convert(values, MPH_PER_KMH)
+
+
+# Function to make a list of API values into a read-only array (None becomes NaN)
+def _frozen_array(values, dtype=np.float32):
+    array = np.array(values if values is not None else [], dtype=dtype)
+    array.flags.writeable = False
+    return array
+
+
+# Function to make an array back into JSON-style values, with None for gaps
+def _to_list(array, digits=2):
+    return [None if np.isnan(value) else value for value in array.astype(np.float64).round(digits).tolist()]
+
+
+class CurrentConditions:
+    """Current conditions at one location, keyed by the Open-Meteo variable names."""
+
+    # Attribute name -> Open-Meteo variable
+    FIELDS = {
+        "temperature": "temperature_2m",
+        "humidity": "relative_humidity_2m",
+        "wind_speed": "wind_speed_10m",
+        "apparent_temperature": "apparent_temperature",
+        "weather_code": "weather_code",
+    }
+
+    __slots__ = ("time", *FIELDS)
+
+    def __init__(self, time=None, temperature=None, humidity=None, wind_speed=None,
+                 apparent_temperature=None, weather_code=None):
+        self.time = time
+        self.temperature = temperature
+        self.humidity = humidity
+        self.wind_speed = wind_speed
+        self.apparent_temperature = apparent_temperature
+        self.weather_code = weather_code
+
+    @classmethod
+    def from_payload(cls, current):
+        return cls(current.get("time"), **{field: current.get(name) for field, name in cls.FIELDS.items()})
+
+    @property
+    def weather(self):
+        return weather_labels([self.weather_code if self.weather_code is not None else -1])[0]
+
+    def in_units(self, unit):
+        return CurrentConditions(
+            self.time,
+            temperature=convert_temperature(self.temperature, unit),
+            humidity=self.humidity,
+            wind_speed=convert_wind_speed(self.wind_speed),
+            apparent_temperature=convert_temperature(self.apparent_temperature, unit),
+            weather_code=self.weather_code,
+        )
+
+    def to_dict(self):
+        # The API's shape, for callers that still want a plain dict
+        data = {"time": self.time} if self.time is not None else {}
+        for field, name in self.FIELDS.items():
+            value = getattr(self, field)
+            if value is not None:
+                data[name] = value
+        return data
+
+
+class HourlySeries:
+    """Hourly forecast as typed arrays: UTC epoch seconds plus float32 values, in time order.
+    Variables that weren't requested are None."""
+
+    __slots__ = ("epochs", "temperature", "humidity", "utc_offset_seconds", "version")
+
+    def __init__(self, epochs, temperature, humidity, utc_offset_seconds=0, version=None):
+        self.epochs = epochs
+        self.temperature = temperature
+        self.humidity = humidity
+        self.utc_offset_seconds = utc_offset_seconds
+        # Identifies the fetch this series came from; changes whenever the data does
+        self.version = version
+
+    @classmethod
+    def from_payload(cls, hourly, utc_offset_seconds=0, version=None):
+        # Open-Meteo sends local wall-clock times; shift them back to UTC epochs
+        local = np.array(hourly["time"], dtype="datetime64[s]").astype(np.int64)
+        epochs = local - utc_offset_seconds
+        epochs.flags.writeable = False  # Shared read-only between sessions
+
+        def values(name):
+            return _frozen_array(hourly[name]) if name in hourly else None
+
+        return cls(epochs, values("temperature_2m"), values("relative_humidity_2m"), utc_offset_seconds, version)
+
+    def in_units(self, unit):
+        # Shares the time and humidity arrays; only the temperatures are converted
+        if unit != "fahrenheit":
+            return self
+        return HourlySeries(self.epochs, convert_temperature(self.temperature, unit), self.humidity,
+                            self.utc_offset_seconds, (self.version, unit))
+
+    def window(self, start_epoch, end_epoch):
+        # Index range [i, j) of the points between the two instants, found by binary search
+        i = int(np.searchsorted(self.epochs, start_epoch, side="left"))
+        j = int(np.searchsorted(self.epochs, end_epoch, side="right"))
+        return i, j
+
+    def local_times(self, i, j):
+        return (self.epochs[i:j] + self.utc_offset_seconds).astype("datetime64[s]")
+
+    def to_dict(self):
+        data = {"time": [str(t)[:16] for t in self.local_times(0, len(self))]}
+        for name, values in (("temperature_2m", self.temperature), ("relative_humidity_2m", self.humidity)):
+            if values is not None:
+                data[name] = _to_list(values)
+        return data
+
+    def __len__(self):
+        return len(self.epochs)
+
+
+class DailySeries:
+    """Daily outlook as typed arrays, one entry per local calendar day. Variables that
+    weren't requested are None."""
+
+    __slots__ = ("dates", "sunrise", "sunset", "temperature_max", "temperature_min",
+                 "precipitation_probability", "weather_code", "version")
+
+    def __init__(self, dates, sunrise=None, sunset=None, temperature_max=None, temperature_min=None,
+                 precipitation_probability=None, weather_code=None, version=None):
+        self.dates = dates
+        self.sunrise = sunrise
+        self.sunset = sunset
+        self.temperature_max = temperature_max
+        self.temperature_min = temperature_min
+        self.precipitation_probability = precipitation_probability
+        self.weather_code = weather_code
+        self.version = version
+
+    @classmethod
+    def from_payload(cls, daily, version=None):
+        def times(name, unit):
+            return _frozen_array(daily[name], f"datetime64[{unit}]") if name in daily else None
+
+        def values(name):
+            return _frozen_array(daily[name]) if name in daily else None
+
+        codes = daily.get("weather_code", daily.get("weathercode"))
+        if codes is not None:
+            codes = _frozen_array([-1 if code is None else code for code in codes], np.int16)
+        return cls(
+            times("time", "D"),
+            sunrise=times("sunrise", "m"),
+            sunset=times("sunset", "m"),
+            temperature_max=values("temperature_2m_max"),
+            temperature_min=values("temperature_2m_min"),
+            precipitation_probability=values("precipitation_probability_max"),
+            weather_code=codes,
+            version=version,
+        )
+
+    def weather(self):
+        return weather_labels(self.weather_code)
+
+    def in_units(self, unit):
+        if unit != "fahrenheit":
+            return self
+        return DailySeries(
+            self.dates,
+            sunrise=self.sunrise,
+            sunset=self.sunset,
+            temperature_max=convert_temperature(self.temperature_max, unit),
+            temperature_min=convert_temperature(self.temperature_min, unit),
+            precipitation_probability=self.precipitation_probability,
+            weather_code=self.weather_code,
+            version=(self.version, unit),  # Figures and tables built from it are cached per unit
+        )
+
+    def to_dict(self):
+        data = {}
+        if self.dates is not None:
+            data["time"] = [str(day) for day in self.dates]
+        for name, times in (("sunrise", self.sunrise), ("sunset", self.sunset)):
+            if times is not None:
+                data[name] = [str(t) for t in times]
+        for name, values in (("temperature_2m_max", self.temperature_max),
+                             ("temperature_2m_min", self.temperature_min),
+                             ("precipitation_probability_max", self.precipitation_probability)):
+            if values is not None:
+                data[name] = _to_list(values)
+        if self.weather_code is not None:
+            data["weathercode"] = [None if code < 0 else code for code in self.weather_code.tolist()]
+        return data
+
+    def __len__(self):
+        return len(self.dates) if self.dates is not None else 0
+
+
+# Function to parse one kind of forecast data ("current", "hourly" or "daily") into its model,
+# or None if the response didn't include it
+def model_from_payload(kind, values, utc_offset_seconds=0, version=None):
+    if not values:
+        return None
+    if kind == "current":
+        return CurrentConditions.from_payload(values)
+    if kind == "hourly":
+        return HourlySeries.from_payload(values, utc_offset_seconds, version)
+    return DailySeries.from_payload(values, version)
@@ -0,0 +1,438 @@
+import bisect
+import collections
+import csv
+import difflib
+import ipaddress
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import http_client
+import metrics
+from weather_cache import TTLCache
+
+GEOCODE_DB = os.environ.get("WEATHER_GEOCODE_DB", "geocode_cache.db")
+
+# Optional GeoNames dump (e.g. cities15000.txt from download.geonames.org/export/dump/)
+GAZETTEER_FILE = os.environ.get("WEATHER_GAZETTEER_FILE", "cities15000.txt")
+
+# Optional IP-range to city CSV (start_ip,end_ip,city,lat,lon), e.g. exported from a "city lite" database
+IP_DATABASE_FILE = os.environ.get("WEATHER_IP_DATABASE_FILE", "ip_city.csv")
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+
+# Nominatim's usage policy allows one request per second from the whole application
+NOMINATIM_RATE = 1.0
+NOMINATIM_BURST = 1
+
+# Longest a search waits for a free request slot before giving up
+MAX_RATE_WAIT = 2.0
+
+# Nominatim's own session: it only retries connection errors, since every request has to take
+# a token from the rate limiter and a retried 429 or 5xx would go around it
+nominatim_session = http_client.create_session(pool_size=2, retry=http_client.CONNECT_RETRY)
+
+# Seconds a name Nominatim doesn't know is remembered, so retyping it doesn't ask again
+NEGATIVE_TTL = 60 * 60
+
+
+# Function to normalize a search string so "new  York " and "New York" share a cache entry
+def normalize_query(query):
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+
+class GeocodeStore:
+    """SQLite cache of geocoding results, keyed by the normalized query string."""
+
+    def __init__(self, path=GEOCODE_DB):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._pending_searches = collections.Counter()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS geocodes (
+                    query TEXT PRIMARY KEY,
+                    name TEXT,
+                    lat REAL NOT NULL,
+                    lon REAL NOT NULL,
+                    display_name TEXT NOT NULL,
+                    addresstype TEXT,
+                    type TEXT,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS searches (
+                    query TEXT PRIMARY KEY,
+                    count INTEGER NOT NULL
+                )"""
+            )
+
+    @metrics.instrument("geocode_store.get")
+    def get(self, query):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT name, lat, lon, display_name, addresstype, type FROM geocodes WHERE query = ?",
+                (normalize_query(query),),
+            ).fetchone()
+        metrics.record_cache(row is not None)
+        if row is None:
+            return None
+        name, lat, lon, display_name, addresstype, place_type = row
+        return {
+            "name": name,
+            "lat": lat,
+            "lon": lon,
+            "display_name": display_name,
+            "addresstype": addresstype,
+            "type": place_type,
+        }
+
+    @metrics.instrument("geocode_store.put")
+    def put(self, query, location):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    normalize_query(query),
+                    location.get("name"),
+                    float(location["lat"]),
+                    float(location["lon"]),
+                    location["display_name"],
+                    location.get("addresstype"),
+                    location.get("type"),
+                    time.time(),
+                ),
+            )
+
+    def record_search(self, query):
+        # Counted in memory and written in batches, so searching doesn't cost a write
+        with self._lock:
+            self._pending_searches[normalize_query(query)] += 1
+
+    def flush_searches(self):
+        with self._lock, self._conn:
+            pending, self._pending_searches = self._pending_searches, collections.Counter()
+            self._conn.executemany(
+                """INSERT INTO searches VALUES (?, ?)
+                   ON CONFLICT(query) DO UPDATE SET count = count + excluded.count""",
+                pending.items(),
+            )
+
+    def top_searches(self, limit=20):
+        # The most searched queries, most popular first
+        self.flush_searches()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT query FROM searches ORDER BY count DESC, query LIMIT ?", (limit,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def suggest(self, prefix, limit=5):
+        # Previously resolved places whose query starts with the prefix, most searched first.
+        # The range condition is answered from the primary key index.
+        key = normalize_query(prefix)
+        if not key:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT g.name, g.lat, g.lon, g.display_name, g.addresstype, g.type
+                   FROM geocodes g LEFT JOIN searches s ON s.query = g.query
+                   WHERE g.query >= ? AND g.query < ?
+                   GROUP BY g.display_name
+                   ORDER BY SUM(COALESCE(s.count, 0)) DESC, MIN(g.query)
+                   LIMIT ?""",
+                (key, key + "\uffff", limit),
+            ).fetchall()
+        return [
+            {"name": name, "lat": lat, "lon": lon, "display_name": display_name, "addresstype": addresstype, "type": place_type}
+            for name, lat, lon, display_name, addresstype, place_type in rows
+        ]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Gazetteer:
+    """In-memory city index built from a GeoNames-style dump, for lookups without any network call."""
+
+    def __init__(self, places):
+        # places: iterable of (name, lat, lon, display_name, population)
+        entries = []
+        for name, lat, lon, display_name, population in places:
+            entries.append((normalize_query(name), -population, name, lat, lon, display_name))
+        entries.sort()
+        self._keys = [entry[0] for entry in entries]
+        self._entries = entries
+
+    @classmethod
+    def from_geonames(cls, path, min_population=0):
+        places = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                cols = line.rstrip("\n").split("\t")
+                # Only populated places (feature class "P")
+                if len(cols) < 15 or cols[6] != "P":
+                    continue
+                population = int(cols[14] or 0)
+                if population < min_population:
+                    continue
+                lat, lon = float(cols[4]), float(cols[5])
+                display_name = f"{cols[1]}, {cols[8]}"
+                places.append((cols[1], lat, lon, display_name, population))
+                if cols[2] and cols[2] != cols[1]:
+                    places.append((cols[2], lat, lon, display_name, population))
+        return cls(places)
+
+    def _location(self, entry):
+        key, _, name, lat, lon, display_name = entry
+        return {
+            "name": name,
+            "lat": lat,
+            "lon": lon,
+            "display_name": display_name,
+            "addresstype": "city",
+            "type": "city",
+        }
+
+    def _prefix_range(self, prefix):
+        start = bisect.bisect_left(self._keys, prefix)
+        end = bisect.bisect_left(self._keys, prefix + "\uffff", start)
+        return start, end
+
+    def suggest(self, prefix, limit=5):
+        # Most populous places whose name starts with the prefix
+        start, end = self._prefix_range(normalize_query(prefix))
+        matches = sorted(self._entries[start:end], key=lambda entry: entry[1])
+        return [self._location(entry) for entry in matches[:limit]]
+
+    def lookup(self, query, cutoff=0.85):
+        key = normalize_query(query)
+        if not key:
+            return None
+
+        # Exact name match; entries sort by population within a name, so the first is the largest
+        start, end = self._prefix_range(key)
+        if start < end and self._keys[start] == key:
+            return self._location(self._entries[start])
+
+        # Fuzzy match to tolerate small typos, against names sharing the first two letters and
+        # close enough in length to reach the cutoff at all (difflib's ratio is 2*matches/total)
+        start, end = self._prefix_range(key[:2])
+        shortest = len(key) * cutoff / (2 - cutoff)
+        longest = len(key) * (2 - cutoff) / cutoff
+        candidates = [name for name in dict.fromkeys(self._keys[start:end]) if shortest <= len(name) <= longest]
+        close = difflib.get_close_matches(key, candidates, n=1, cutoff=cutoff)
+        if close:
+            index = bisect.bisect_left(self._keys, close[0])
+            return self._location(self._entries[index])
+        return None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class IPRangeDatabase:
+    """Sorted IP ranges mapped to cities, looked up with a binary search instead of a network call."""
+
+    def __init__(self, ranges):
+        # ranges: iterable of (start_ip, end_ip, city, lat, lon)
+        rows = sorted(
+            (int(ipaddress.ip_address(start)), int(ipaddress.ip_address(end)), city, float(lat), float(lon))
+            for start, end, city, lat, lon in ranges
+        )
+        self._starts = [row[0] for row in rows]
+        self._rows = rows
+
+    @classmethod
+    def from_csv(cls, path):
+        ranges = []
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                if len(row) < 5 or row[0].startswith("start"):
+                    continue  # Skip the header and malformed rows
+                ranges.append(row[:5])
+        return cls(ranges)
+
+    def lookup(self, ip):
+        try:
+            address = int(ipaddress.ip_address(ip))
+        except ValueError:
+            return None
+        index = bisect.bisect_right(self._starts, address) - 1
+        if index < 0:
+            return None
+        start, end, city, lat, lon = self._rows[index]
+        if address > end:
+            return None
+        return city, lat, lon
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class GeocodingError(Exception):
+    """Nominatim answered with an error status."""
+
+    def __init__(self, status_code, text):
+        super().__init__(f"status code {status_code}: {text}")
+        self.status_code = status_code
+        self.text = text
+
+
+class RateLimited(Exception):
+    """No Nominatim request slot freed up in time."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` requests per second, in bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        # Reserves the next free slot and sleeps until it comes round, so waiting callers
+        # are served in order without polling. Returns False if that is more than timeout away.
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if timeout is not None and wait > timeout:
+                return False
+            self._tokens -= 1
+        if wait:
+            self._sleep(wait)
+        return True
+
+
+# Function to ask Nominatim for a place; None means it doesn't know the name
+def fetch_nominatim(query):
+    response = http_client.get(NOMINATIM_URL, params={"q": query, "format": "json", "limit": 1},
+                               via=nominatim_session)
+    if response.status_code != 200:
+        raise GeocodingError(response.status_code, response.text)
+    results = http_client.decode_json(response)
+    return results[0] if results else None
+
+
+class GeocodeScheduler:
+    """
+    Resolves city searches for every session: the geocode cache and gazetteer first, then
+    Nominatim behind one process-wide rate limit. Identical in-flight queries share a request
+    and names Nominatim doesn't know are remembered for a while.
+    """
+
+    def __init__(self, store, gazetteer=None, fetch=fetch_nominatim, limiter=None,
+                 max_wait=MAX_RATE_WAIT, negative_ttl=NEGATIVE_TTL):
+        self._store = store
+        self._gazetteer = gazetteer
+        self._fetch = fetch
+        self._limiter = limiter or TokenBucket(NOMINATIM_RATE, NOMINATIM_BURST)
+        self.max_wait = max_wait
+        self.negative_ttl = negative_ttl
+        # Unknown names; its single-flight loading also coalesces upstream lookups
+        self._unknown = TTLCache(max_entries=4096)
+
+    def cached(self, query):
+        # The place for a query if it can be answered without a network call
+        location = self._store.get(query)
+        if location is None and self._gazetteer is not None:
+            location = self._gazetteer.lookup(query)
+        return location
+
+    @metrics.instrument("geocoder.resolve")
+    def resolve(self, query):
+        key = normalize_query(query)
+        if not key:
+            return None
+        location = self.cached(query)
+        if location is not None or key in self._unknown:
+            return location
+        return self._unknown.coalesce(key, lambda: self._fetch_upstream(query, key))
+
+    def _fetch_upstream(self, query, key):
+        # A lookup that finished while this one was queued may already have the answer
+        location = self._store.get(query)
+        if location is not None or key in self._unknown:
+            return location
+        if not self._limiter.acquire(self.max_wait):
+            raise RateLimited(query)
+        location = self._fetch(query)
+        if location is None:
+            self._unknown.set(key, True, self.negative_ttl)
+        else:
+            self._store.put(query, location)
+        return location
+
+    def suggest(self, prefix, limit=5):
+        # Places resolved before (most searched first), then gazetteer matches
+        suggestions = self._store.suggest(prefix, limit)
+        if self._gazetteer is not None:
+            suggestions += self._gazetteer.suggest(prefix, limit)
+        unique = {}
+        for location in suggestions:
+            unique.setdefault(location["display_name"], location)
+        return list(unique.values())[:limit]
+
+
+_store = None
+_gazetteer = None
+_gazetteer_loaded = False
+_ip_database = None
+_ip_database_loaded = False
+_geocoder = None
+_init_lock = threading.Lock()
+
+
+# Function to get the process-wide geocode cache, opening it on first use
+def get_geocode_store():
+    global _store
+    with _init_lock:
+        if _store is None:
+            _store = GeocodeStore(GEOCODE_DB)
+        return _store
+
+
+# Function to get the gazetteer index, or None when no GeoNames dump is available
+def get_gazetteer():
+    global _gazetteer, _gazetteer_loaded
+    with _init_lock:
+        if not _gazetteer_loaded:
+            if os.path.exists(GAZETTEER_FILE):
+                _gazetteer = Gazetteer.from_geonames(GAZETTEER_FILE)
+            _gazetteer_loaded = True
+        return _gazetteer
+
+
+# Function to get the local IP-range database, or None when it is not installed
+def get_ip_database():
+    global _ip_database, _ip_database_loaded
+    with _init_lock:
+        if not _ip_database_loaded:
+            if os.path.exists(IP_DATABASE_FILE):
+                _ip_database = IPRangeDatabase.from_csv(IP_DATABASE_FILE)
+            _ip_database_loaded = True
+        return _ip_database
+
+
+# Function to get the process-wide geocoding scheduler shared by every session
+def get_geocoder():
+    global _geocoder
+    store = get_geocode_store()
+    gazetteer = get_gazetteer()
+    with _init_lock:
+        if _geocoder is None:
+            _geocoder = GeocodeScheduler(store, gazetteer)
+        return _geocoder
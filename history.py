@@ -0,0 +1,119 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+import metrics
+from forecast_models import HourlySeries
+
+HISTORY_DB = os.environ.get("WEATHER_HISTORY_DB", "weather_history.db")
+
+# Recorded hours older than this are dropped
+HISTORY_DAYS = 45
+
+HOUR = 3600
+
+# Most points a range is drawn with; longer ranges are averaged into wider buckets
+MAX_POINTS = 240
+
+
+# Function to pick the bucket size (a whole number of hours) that fits a range into max_points
+def bucket_seconds(start, end, max_points=MAX_POINTS):
+    hours = math.ceil(max(end - start, HOUR) / HOUR)
+    return math.ceil(hours / max_points) * HOUR
+
+
+class HistoryStore:
+    """
+    Hourly temperature and humidity recorded from every forecast fetched, in SQLite.
+    Rows are keyed by (lat, lon, time), so a range for one location is a single index
+    scan, and are kept in the canonical units the forecast cache uses (celsius).
+    """
+
+    def __init__(self, path=HISTORY_DB, retention_days=HISTORY_DAYS, clock=time.time):
+        self.path = path
+        self.retention = retention_days * 24 * HOUR
+        self._clock = clock
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS hourly (
+                    lat REAL NOT NULL,
+                    lon REAL NOT NULL,
+                    time INTEGER NOT NULL,
+                    temperature REAL,
+                    humidity REAL,
+                    PRIMARY KEY (lat, lon, time)
+                ) WITHOUT ROWID"""
+            )
+
+    @metrics.instrument("history.record")
+    def record(self, lat, lon, series):
+        # Only hours that have already happened; a later fetch's value for an hour replaces
+        # an earlier one, so each recorded hour ends up as close to the observation as we saw
+        now = self._clock()
+        i, j = series.window(now - self.retention, now)
+        if i == j:
+            return 0
+
+        def column(values):
+            return [None] * (j - i) if values is None else [None if math.isnan(v) else v for v in values[i:j].tolist()]
+
+        rows = zip([lat] * (j - i), [lon] * (j - i), series.epochs[i:j].tolist(),
+                   column(series.temperature), column(series.humidity))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                """INSERT INTO hourly VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(lat, lon, time) DO UPDATE SET
+                       temperature = COALESCE(excluded.temperature, temperature),
+                       humidity = COALESCE(excluded.humidity, humidity)""",
+                rows,
+            )
+            self._conn.execute("DELETE FROM hourly WHERE lat = ? AND lon = ? AND time < ?",
+                               (lat, lon, int(now - self.retention)))
+        return j - i
+
+    @metrics.instrument("history.range")
+    def range(self, lat, lon, start, end, step=HOUR, utc_offset_seconds=0):
+        # Recorded hours in [start, end) as an HourlySeries, averaged into step-second buckets
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT time / :step * :step AS bucket, AVG(temperature), AVG(humidity) FROM hourly
+                   WHERE lat = :lat AND lon = :lon AND time >= :start AND time < :end
+                   GROUP BY bucket ORDER BY bucket""",
+                {"step": int(step), "lat": lat, "lon": lon, "start": int(start), "end": int(end)},
+            ).fetchall()
+        epochs, temperature, humidity = zip(*rows) if rows else ((), (), ())
+        return HourlySeries(
+            np.array(epochs, dtype=np.int64),
+            np.array(temperature, dtype=np.float32),
+            np.array(humidity, dtype=np.float32),
+            utc_offset_seconds,
+        )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM hourly").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_history = None
+_init_lock = threading.Lock()
+
+
+# Function to get the process-wide history store
+def get_history_store():
+    global _history
+    with _init_lock:
+        if _history is None:
+            _history = HistoryStore(HISTORY_DB)
+        return _history
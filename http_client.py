@@ -0,0 +1,98 @@
+import json
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+try:
+    import orjson  # Optional: decodes large forecast responses several times faster
+except ImportError:
+    orjson = None
+
+# (connect, read) timeouts in seconds, so a hung upstream can't block a script thread forever
+TIMEOUT = (3.05, 10)
+
+# Connections kept alive per host; sized for the favorites fan-out plus concurrent sessions
+POOL_SIZE = 20
+
+# Nominatim's usage policy requires an identifying User-Agent
+USER_AGENT = "WeatherDashboardApp/ (noahjacobkurian@gmail.com)"
+
+# Ask upstreams for compressed responses (set WEATHER_HTTP_GZIP=0 to turn off)
+GZIP = os.environ.get("WEATHER_HTTP_GZIP", "1") != "0"
+
+# Longest we are willing to wait on a Retry-After header before giving up
+MAX_RETRY_AFTER = 5
+
+
+class _Retry(Retry):
+    """Retry policy that caps how long a server's Retry-After can stall a rerun."""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, MAX_RETRY_AFTER)
+
+
+# A few quick, jittered retries on connection errors, rate limiting and server errors
+RETRY = _Retry(
+    total=3,
+    connect=2,
+    read=1,
+    status=3,
+    backoff_factor=0.3,
+    backoff_jitter=0.3,
+    backoff_max=4,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({"GET"}),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+# Connection errors only, for services whose error responses shouldn't be repeated
+# straight away (a retried 5xx or 429 would just add to their load)
+CONNECT_RETRY = _Retry(
+    total=2,
+    connect=2,
+    read=0,
+    status=0,
+    backoff_factor=0.3,
+    backoff_jitter=0.3,
+    allowed_methods=frozenset({"GET"}),
+    raise_on_status=False,
+)
+
+
+# Function to build a keep-alive session with pooling and retries
+def create_session(pool_size=POOL_SIZE, retry=RETRY, gzip=GZIP):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    session.headers["Accept-Encoding"] = "gzip, deflate" if gzip else "identity"
+    return session
+
+
+# One keep-alive session shared by every fetcher in the process
+session = create_session()
+
+
+# Function to send a GET request through the shared session, or through `via` (another session
+# from create_session) for services that need different retries
+def get(url, params=None, headers=None, timeout=TIMEOUT, via=None):
+    response = (via or session).get(url, params=params, headers=headers, timeout=timeout)
+    if metrics.ENABLED:
+        metrics.add_bytes(len(response.content))
+    return response
+
+
+# Function to decode a JSON response body with the fastest decoder available
+def decode_json(response):
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return json.loads(response.content)
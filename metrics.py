@@ -0,0 +1,220 @@
+import contextvars
+import functools
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Instrumentation is off unless WEATHER_METRICS=1. When off, instrument() hands back the
+# undecorated function and span() a shared no-op, so the hot path pays nothing.
+ENABLED = os.environ.get("WEATHER_METRICS", "0") == "1"
+
+# Serve Prometheus text on this port (at /metrics) when set
+METRICS_PORT = int(os.environ.get("WEATHER_METRICS_PORT", "0"))
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current_span = contextvars.ContextVar("weather_current_span", default=None)
+_current_trace = contextvars.ContextVar("weather_current_trace", default=None)
+
+
+class Span:
+    """One timed call: when it started, how long it took, bytes moved and cache result."""
+
+    __slots__ = ("name", "start", "duration", "bytes", "cache", "depth")
+
+    def __init__(self, name, start, depth):
+        self.name = name
+        self.start = start
+        self.duration = 0.0
+        self.bytes = 0
+        self.cache = None
+        self.depth = depth
+
+
+class Registry:
+    """Aggregated span statistics for the whole process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}  # name -> [bucket counts..., count, sum, bytes, hits, misses]
+        self._caches = {}
+
+    def observe(self, span):
+        with self._lock:
+            stats = self._stats.get(span.name)
+            if stats is None:
+                stats = self._stats[span.name] = [0] * len(BUCKETS) + [0, 0.0, 0, 0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if span.duration <= bound:
+                    stats[i] += 1
+            n = len(BUCKETS)
+            stats[n] += 1
+            stats[n + 1] += span.duration
+            stats[n + 2] += span.bytes
+            if span.cache == "hit":
+                stats[n + 3] += 1
+            elif span.cache == "miss":
+                stats[n + 4] += 1
+
+    def register_cache(self, name, cache):
+        self._caches[name] = cache
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+    def render_prometheus(self):
+        n = len(BUCKETS)
+        lines = [
+            "# HELP weather_span_duration_seconds Time spent in instrumented dashboard calls.",
+            "# TYPE weather_span_duration_seconds histogram",
+        ]
+        with self._lock:
+            stats = {name: list(values) for name, values in sorted(self._stats.items())}
+        for name, values in stats.items():
+            for bound, count in zip(BUCKETS, values[:n]):
+                lines.append(f'weather_span_duration_seconds_bucket{{span="{name}",le="{bound}"}} {count}')
+            lines.append(f'weather_span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {values[n]}')
+            lines.append(f'weather_span_duration_seconds_sum{{span="{name}"}} {values[n + 1]:.6f}')
+            lines.append(f'weather_span_duration_seconds_count{{span="{name}"}} {values[n]}')
+
+        lines += ["# HELP weather_span_bytes_total Response bytes read inside each span.",
+                  "# TYPE weather_span_bytes_total counter"]
+        for name, values in stats.items():
+            lines.append(f'weather_span_bytes_total{{span="{name}"}} {values[n + 2]}')
+
+        lines += ["# HELP weather_span_cache_total Cache hits and misses seen by each span.",
+                  "# TYPE weather_span_cache_total counter"]
+        for name, values in stats.items():
+            if values[n + 3] or values[n + 4]:
+                lines.append(f'weather_span_cache_total{{span="{name}",result="hit"}} {values[n + 3]}')
+                lines.append(f'weather_span_cache_total{{span="{name}",result="miss"}} {values[n + 4]}')
+
+        if self._caches:
+            lines += ["# HELP weather_cache_entries Entries held by each shared cache.",
+                      "# TYPE weather_cache_entries gauge"]
+            cache_stats = {name: cache.stats() for name, cache in sorted(self._caches.items())}
+            for name, values in cache_stats.items():
+                lines.append(f'weather_cache_entries{{cache="{name}"}} {values["entries"]}')
+            for field in ("hits", "misses", "evictions"):
+                lines += [f"# TYPE weather_cache_{field}_total counter"]
+                for name, values in cache_stats.items():
+                    lines.append(f'weather_cache_{field}_total{{cache="{name}"}} {values[field]}')
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class _SpanContext:
+    __slots__ = ("name", "span", "token")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.span = Span(self.name, time.perf_counter(), parent.depth + 1 if parent else 0)
+        self.token = _current_span.set(self.span)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.append(self.span)
+        return self.span
+
+    def __exit__(self, *exc):
+        self.span.duration = time.perf_counter() - self.span.start
+        _current_span.reset(self.token)
+        registry.observe(self.span)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+# Function to time a block: `with metrics.span("name"):`
+def span(name):
+    return _SpanContext(name) if ENABLED else _NOOP
+
+
+# Decorator that records a span for every call of the function
+def instrument(name=None):
+    def decorator(func):
+        if not ENABLED:
+            return func
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _SpanContext(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Function to add response bytes to the span currently running
+def add_bytes(n):
+    if ENABLED:
+        current = _current_span.get()
+        if current is not None:
+            current.bytes += n
+
+
+# Function to note a cache hit or miss on the span currently running
+def record_cache(hit):
+    if ENABLED:
+        current = _current_span.get()
+        if current is not None and current.cache != "miss":
+            current.cache = "hit" if hit else "miss"
+
+
+# Function to start collecting this rerun's spans; returns the list they are added to
+def start_trace():
+    if not ENABLED:
+        return None
+    trace = []
+    _current_trace.set(trace)
+    return trace
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+# Function to serve /metrics in a background thread (once per process)
+def start_metrics_server(port=METRICS_PORT):
+    global _server
+    with _server_lock:
+        if _server is None and port:
+            _server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+        return _server
@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# How often each watched forecast is refreshed, and how often the sections re-render from the cache
+REFRESH_INTERVAL = 10 * 60
+
+# Forecasts nobody has looked at for this long stop being refreshed
+IDLE_TIMEOUT = 30 * 60
+
+# How often the background thread wakes up to look for due forecasts
+TICK = 15
+
+# How often the cache warmer prefetches favorite and popular cities. Shorter than the
+# 15 minute current-conditions TTL, so their entries never expire between runs.
+WARM_INTERVAL = 10 * 60
+
+# Time after start-up before the first warm, so it doesn't compete with the first sessions
+WARM_DELAY = 60
+
+
+class ForecastRefresher:
+    """
+    Background thread that keeps the forecasts sessions are viewing fresh in the shared cache.
+    Each distinct key is refreshed once per interval, however many sessions watch it.
+    """
+
+    def __init__(self, refresh, interval=REFRESH_INTERVAL, idle_timeout=IDLE_TIMEOUT, tick=TICK, clock=time.monotonic):
+        self._refresh = refresh
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.tick = tick
+        self._clock = clock
+        self._watched = {}  # key -> [last_seen, next_due]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.refreshes = 0
+
+    def watch(self, key):
+        # Sessions call this whenever they render a forecast
+        now = self._clock()
+        with self._lock:
+            entry = self._watched.get(key)
+            if entry is None:
+                # The session just fetched it, so the first refresh is due one interval from now
+                self._watched[key] = [now, now + self.interval]
+            else:
+                entry[0] = now
+        self.start()
+
+    def run_once(self):
+        now = self._clock()
+        with self._lock:
+            for key in [key for key, (last_seen, _) in self._watched.items() if now - last_seen > self.idle_timeout]:
+                del self._watched[key]
+            due = [key for key, (_, next_due) in self._watched.items() if next_due <= now]
+            for key in due:
+                self._watched[key][1] = now + self.interval
+
+        for key in due:
+            try:
+                self._refresh(*key)
+                self.refreshes += 1
+            except Exception:
+                logger.exception("Refreshing forecast %r failed", key)
+        return len(due)
+
+    def _run(self):
+        while not self._stop.wait(self.tick):
+            self.run_once()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="forecast-refresher", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def watched(self):
+        with self._lock:
+            return list(self._watched)
+
+
+class CacheWarmer:
+    """Background thread that calls warm() every interval to keep popular forecasts cached."""
+
+    def __init__(self, warm, interval=WARM_INTERVAL, delay=WARM_DELAY):
+        self._warm = warm
+        self.interval = interval
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+
+    def run_once(self):
+        try:
+            self._warm()
+            self.runs += 1
+        except Exception:
+            logger.exception("Warming the forecast cache failed")
+
+    def _run(self):
+        if self._stop.wait(self.delay):
+            return
+        while True:
+            self.run_once()
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="cache-warmer", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+_refresher = None
+_warmer = None
+_init_lock = threading.Lock()
+
+
+# Function to get the process-wide refresher; refresh(*key) is used the first time it is created
+def get_refresher(refresh):
+    global _refresher
+    with _init_lock:
+        if _refresher is None:
+            _refresher = ForecastRefresher(refresh)
+        return _refresher
+
+
+# Function to get the process-wide cache warmer; warm() is used the first time it is created
+def get_warmer(warm):
+    global _warmer
+    with _init_lock:
+        if _warmer is None:
+            _warmer = CacheWarmer(warm)
+        return _warmer
@@ -0,0 +1,128 @@
+import atexit
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+from forecast_models import model_from_payload
+from weather_cache import forecast_cache, stale_forecast_cache, FORECAST_TTLS, STALE_TTL
+
+logger = logging.getLogger(__name__)
+
+# Where the forecast snapshot is kept between restarts (set WEATHER_SNAPSHOT_FILE= to turn it off)
+SNAPSHOT_FILE = os.environ.get("WEATHER_SNAPSHOT_FILE", "forecast_snapshot.json.gz")
+
+# How often the snapshot is rewritten while the app runs
+SNAPSHOT_INTERVAL = 5 * 60
+
+
+class ForecastSnapshot:
+    """
+    The last good forecasts on disk, as gzipped JSON in the API's shape. Loaded once after a
+    restart, so the first sessions are served from the cache and an upstream outage still
+    has something (stale) to show.
+    """
+
+    def __init__(self, path, cache=forecast_cache, stale_cache=stale_forecast_cache,
+                 interval=SNAPSHOT_INTERVAL, clock=time.time):
+        self.path = path
+        self._cache = cache
+        self._stale_cache = stale_cache
+        self.interval = interval
+        self._clock = clock
+        self._stop = threading.Event()
+        self._thread = None
+
+    def save(self):
+        records = []
+        for (lat, lon, kind, names), part in self._stale_cache.items():
+            if part["model"] is None:
+                continue
+            records.append({
+                "key": [lat, lon, kind, list(names)],
+                "fetched_at": part["fetched_at"],
+                "timezone": part["timezone"],
+                "utc_offset_seconds": part["utc_offset_seconds"],
+                "values": part["model"].to_dict(),
+            })
+        # Written to a temporary file first so a crash mid-write can't leave a torn snapshot
+        temp_path = f"{self.path}.tmp"
+        with gzip.open(temp_path, "wt", encoding="utf-8") as f:
+            json.dump(records, f, separators=(",", ":"))
+        os.replace(temp_path, self.path)
+        return len(records)
+
+    def load(self):
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                records = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError):
+            logger.exception("Ignoring unreadable forecast snapshot %s", self.path)
+            return 0
+
+        now = self._clock()
+        loaded = 0
+        for record in records:
+            if len(record["key"]) != 4:
+                continue  # Written before forecasts were cached in one unit
+            lat, lon, kind, names = record["key"]
+            key = (lat, lon, kind, tuple(names))
+            age = now - record["fetched_at"]
+            if age >= STALE_TTL:
+                continue
+            part = {
+                "model": model_from_payload(kind, record["values"], record["utc_offset_seconds"],
+                                            version=(lat, lon, record["fetched_at"])),
+                "timezone": record["timezone"],
+                "utc_offset_seconds": record["utc_offset_seconds"],
+                "fetched_at": record["fetched_at"],
+            }
+            self._stale_cache.set(key, part, STALE_TTL - age)
+            # Still fresh: serve it straight away, for whatever is left of its TTL
+            if age < FORECAST_TTLS[kind] and key not in self._cache:
+                self._cache.set(key, part, FORECAST_TTLS[kind] - age)
+            loaded += 1
+        return loaded
+
+    def _save_quietly(self):
+        try:
+            self.save()
+        except OSError:
+            logger.exception("Writing the forecast snapshot %s failed", self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._save_quietly()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="forecast-snapshot", daemon=True)
+            self._thread.start()
+            atexit.register(self._save_quietly)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+_snapshot = None
+_init_lock = threading.Lock()
+
+
+# Function to load the snapshot the first time the forecast cache is used, then keep it updated
+def ensure_snapshot_loaded():
+    global _snapshot
+    if _snapshot is not None or not SNAPSHOT_FILE:
+        return _snapshot
+    with _init_lock:
+        if _snapshot is None:
+            snapshot = ForecastSnapshot(SNAPSHOT_FILE)
+            snapshot.load()
+            snapshot.start()
+            _snapshot = snapshot
+        return _snapshot
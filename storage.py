@@ -0,0 +1,157 @@
+import csv
+import os
+import sqlite3
+import threading
+
+import metrics
+
+USER_DB = os.environ.get("WEATHER_USER_DB", "weather_users.db")
+
+# Legacy CSV files, imported into the database the first time it is opened
+FAV_FILE = "favorites.csv"
+SETTINGS_FILE = "settings.csv"
+
+
+class UserStore:
+    """Per-user favorites and settings in SQLite, safe for concurrent sessions and processes."""
+
+    def __init__(self, path=USER_DB, fav_file=FAV_FILE, settings_file=SETTINGS_FILE):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS favorites (
+                    user TEXT NOT NULL,
+                    city TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    PRIMARY KEY (user, city)
+                );
+                CREATE TABLE IF NOT EXISTS settings (
+                    user TEXT PRIMARY KEY,
+                    unit TEXT,
+                    sections TEXT,
+                    forecast_range INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                """
+            )
+            self._migrate_csv(fav_file, settings_file)
+
+    def _migrate_csv(self, fav_file, settings_file):
+        # Caller must hold self._lock. BEGIN IMMEDIATE makes concurrent processes take turns.
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            done = self._conn.execute("SELECT 1 FROM meta WHERE key = 'csv_migrated'").fetchone()
+            if not done:
+                if os.path.exists(fav_file):
+                    with open(fav_file, newline="", encoding="utf-8") as f:
+                        for position, row in enumerate(csv.DictReader(f)):
+                            if row.get("user") and row.get("city"):
+                                self._conn.execute(
+                                    "INSERT OR IGNORE INTO favorites VALUES (?, ?, ?)",
+                                    (row["user"], row["city"], position),
+                                )
+                if os.path.exists(settings_file):
+                    with open(settings_file, newline="", encoding="utf-8") as f:
+                        for row in csv.DictReader(f):
+                            if not row.get("user"):
+                                continue
+                            forecast_range = int(float(row["forecast_range"])) if row.get("forecast_range") else None
+                            self._conn.execute(
+                                "INSERT OR REPLACE INTO settings VALUES (?, ?, ?, ?)",
+                                (row["user"], row.get("unit") or None, row.get("sections") or None, forecast_range),
+                            )
+                self._conn.execute("INSERT INTO meta VALUES ('csv_migrated', '1')")
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    @metrics.instrument("storage.get_favorites")
+    def get_favorites(self, user):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT city FROM favorites WHERE user = ? ORDER BY position", (user,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    @metrics.instrument("storage.add_favorite")
+    def add_favorite(self, user, city):
+        # Returns False if the city was already a favorite
+        with self._lock:
+            cursor = self._conn.execute(
+                """INSERT OR IGNORE INTO favorites
+                   SELECT ?, ?, COALESCE(MAX(position) + 1, 0) FROM favorites WHERE user = ?""",
+                (user, city, user),
+            )
+        return cursor.rowcount > 0
+
+    @metrics.instrument("storage.remove_favorite")
+    def remove_favorite(self, user, city):
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM favorites WHERE user = ? AND city = ?", (user, city))
+        return cursor.rowcount > 0
+
+    def all_favorites(self):
+        # Every user's favorites, the most shared cities first (used by the cache warmer)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT city FROM favorites GROUP BY city ORDER BY COUNT(*) DESC, city"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    @metrics.instrument("storage.get_settings")
+    def get_settings(self, user):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT unit, sections, forecast_range FROM settings WHERE user = ?", (user,)
+            ).fetchone()
+        if row is None:
+            return None
+        unit, sections, forecast_range = row
+        return {
+            "unit": unit,
+            "sections": sections.split(",") if sections is not None else None,
+            "forecast_range": forecast_range,
+        }
+
+    @metrics.instrument("storage.save_settings")
+    def save_settings(self, user, unit, sections, forecast_range):
+        # Upsert that only touches the row when a value actually changed; returns True if it wrote
+        with self._lock:
+            cursor = self._conn.execute(
+                """INSERT INTO settings VALUES (?, ?, ?, ?)
+                   ON CONFLICT(user) DO UPDATE SET
+                       unit = excluded.unit,
+                       sections = excluded.sections,
+                       forecast_range = excluded.forecast_range
+                   WHERE unit IS NOT excluded.unit
+                      OR sections IS NOT excluded.sections
+                      OR forecast_range IS NOT excluded.forecast_range""",
+                (user, unit, ",".join(sections), forecast_range),
+            )
+        return cursor.rowcount > 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_store = None
+_init_lock = threading.Lock()
+
+
+# Function to get the process-wide user store, opening (and migrating) it on first use
+def get_user_store():
+    global _store
+    with _init_lock:
+        if _store is None:
+            _store = UserStore(USER_DB)
+        return _store
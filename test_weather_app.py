@@ -1,5 +1,40 @@
+import json
+import threading
+import time
+
 import pytest
+import weather_dashboard
+import weather_core
 from weather_dashboard import get_weather, get_coordinates, get_current_location, get_hourly_weather, get_sunrise_sunset, get_7_day_forecast
+from weather_dashboard import section_variables, plan_data, cached_forecast, get_favorites_overview
+from weather_cache import TTLCache, forecast_cache, stale_forecast_cache, location_cache, figure_cache
+from forecast_models import HourlySeries
+import geocoding
+from geocoding import GeocodeStore, Gazetteer, IPRangeDatabase, GeocodeScheduler, TokenBucket, RateLimited
+import storage
+from storage import UserStore
+from refresher import ForecastRefresher
+import metrics
+import snapshot
+import history
+from history import HistoryStore
+
+
+@pytest.fixture(autouse=True)
+def clear_caches(tmp_path, monkeypatch):
+    forecast_cache.clear()
+    stale_forecast_cache.clear()
+    monkeypatch.setattr(snapshot, "SNAPSHOT_FILE", "")
+    location_cache.clear()
+    figure_cache.clear()
+    monkeypatch.setattr(geocoding, "_ip_database", None)
+    monkeypatch.setattr(geocoding, "_ip_database_loaded", True)
+    monkeypatch.setattr(geocoding, "_store", GeocodeStore(str(tmp_path / "geocode.db")))
+    monkeypatch.setattr(geocoding, "_gazetteer", None)
+    monkeypatch.setattr(geocoding, "_gazetteer_loaded", True)
+    monkeypatch.setattr(geocoding, "_geocoder", None)
+    monkeypatch.setattr(history, "_history", HistoryStore(str(tmp_path / "history.db")))
+    yield
 
 # Test 1: Valid city coordinates
 def test_get_coordinates_valid_city():
@@ -57,3 +92,673 @@ def test_get_7_day_forecast_valid():
     assert "daily" in forecast
     assert "temperature_2m_max" in forecast["daily"]
     assert "temperature_2m_min" in forecast["daily"]
+
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+        self.text = str(payload)
+        self.content = json.dumps(payload).encode()
+
+    def json(self):
+        return self.payload
+
+
+# Current conditions whose temperature is the latitude; a list for comma-separated bulk requests
+def fake_current_response(params):
+    payloads = [{"current": {"temperature_2m": float(lat)}, "timezone": "GMT", "utc_offset_seconds": 0}
+                for lat in str(params["latitude"]).split(",")]
+    return FakeResponse(payloads if len(payloads) > 1 else payloads[0])
+
+
+class FakeRetryAfterResponse:
+    def __init__(self, retry_after):
+        self.headers = {"Retry-After": retry_after}
+
+
+# Test 8: Only the variables of the selected sections are requested
+def test_section_variables():
+    variables = section_variables(["Sunrise/Sunset", "7-Day Forecast"])
+    assert variables["current"] == ()
+    assert variables["hourly"] == ()
+    assert variables["daily"][:2] == ("sunrise", "sunset")
+    assert "temperature_2m_max" in variables["daily"]
+
+# Test 9: All selected sections come back from one forecast request
+def test_forecast_plan_single_request(monkeypatch):
+    calls = []
+
+    def fake_get(url, params=None, **kwargs):
+        calls.append(params)
+        return FakeResponse({
+            "timezone": "America/New_York",
+            "utc_offset_seconds": -14400,
+            "current": {"temperature_2m": 70},
+            "hourly": {"time": [], "temperature_2m": [], "relative_humidity_2m": []},
+            "daily": {"sunrise": ["2025-04-01T06:40"], "sunset": ["2025-04-01T19:20"]},
+        })
+
+    monkeypatch.setattr(weather_dashboard.http_client, "get", fake_get)
+    plan = plan_data(["Current Weather", "Hourly Graph", "Sunrise/Sunset"])
+    data = cached_forecast(40.7, -74.0, "fahrenheit", **plan.variables())
+    assert len(calls) == 1
+    assert "current" in calls[0] and "hourly" in calls[0] and "daily" in calls[0]
+    assert data["current"].temperature == 158.0  # Fetched in celsius, shown in fahrenheit
+    assert data["utc_offset_seconds"] == -14400
+
+# Test 10: No request is made when no sections are selected
+def test_no_sections_no_request(monkeypatch):
+    import asyncio
+
+    monkeypatch.setattr(weather_dashboard.http_client, "get", lambda *a, **k: pytest.fail("unexpected request"))
+    assert not plan_data([]).needs_forecast
+    assert asyncio.run(weather_dashboard.render_sections_async(40.7, -74.0, "fahrenheit", (), 12, ("Lima",))) is None
+
+# Test 11: Cache entries expire after their TTL and are evicted least-recently-used first
+def test_ttl_cache_expiry_and_eviction():
+    now = [0.0]
+    cache = TTLCache(max_entries=2, clock=lambda: now[0])
+    cache.set("a", 1, ttl=10)
+    cache.set("b", 2, ttl=100)
+    assert cache.get("a") == 1
+    cache.set("c", 3, ttl=100)  # evicts "b", since "a" was used more recently
+    assert cache.get("b", None) is None
+    now[0] = 11
+    assert cache.get("a", None) is None
+    assert cache.get("c") == 3
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 2 and stats["misses"] == 2
+
+# Test 12: Concurrent loads of the same key only call the loader once
+def test_ttl_cache_single_flight():
+    cache = TTLCache()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.05)
+        return "forecast"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load("k", loader, ttl=60))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ["forecast"] * 8
+    assert len(calls) == 1
+
+# Test 13: Repeated forecast lookups for nearby coordinates, in either unit, are served from the cache
+def test_cached_forecast_reuses_entries(monkeypatch):
+    calls = []
+
+    def fake_get(url, params=None, **kwargs):
+        calls.append(params)
+        return FakeResponse({"current": {"temperature_2m": 21.5, "wind_speed_10m": 16.09344},
+                             "timezone": "GMT", "utc_offset_seconds": 0})
+
+    monkeypatch.setattr(weather_dashboard.http_client, "get", fake_get)
+    assert get_weather(40.7128, -74.0060)["current"]["temperature_2m"] == 70.7
+    assert get_weather(40.7131, -74.0058)["current"]["temperature_2m"] == 70.7
+    assert len(calls) == 1
+    assert "temperature_unit" not in calls[0] and "wind_speed_unit" not in calls[0]
+
+    # Switching unit converts the cached forecast instead of fetching it again
+    celsius = get_weather(40.7128, -74.0060, "celsius")["current"]
+    assert celsius == {"temperature_2m": 21.5, "wind_speed_10m": 10.0}
+    assert len(calls) == 1
+
+# Test 14: Geocoding results are persisted and reused for the same normalized query
+def test_get_coordinates_uses_geocode_cache(monkeypatch):
+    calls = []
+
+    def fake_get(url, **kwargs):
+        calls.append(url)
+        return FakeResponse([{"name": "Boston", "lat": "42.36", "lon": "-71.06", "display_name": "Boston, Massachusetts, United States",
+                              "addresstype": "city", "type": "administrative"}])
+
+    monkeypatch.setattr(weather_dashboard.http_client, "get", fake_get)
+    assert get_coordinates("Boston") == (42.36, -71.06, "Boston, Massachusetts, United States")
+    assert get_coordinates("  boston ") == (42.36, -71.06, "Boston, Massachusetts, United States")
+    assert len(calls) == 1
+
+# Test 15: Cached results that are not cities are still rejected
+def test_get_coordinates_cached_result_still_filtered(monkeypatch):
+    geocoding.get_geocode_store().put("Main Street", {"name": "Main St", "lat": 1.0, "lon": 2.0, "display_name": "Main St",
+                                                      "addresstype": "road", "type": "residential"})
+    monkeypatch.setattr(weather_dashboard.http_client, "get", lambda *a, **k: pytest.fail("unexpected request"))
+    assert get_coordinates("Main Street") == (None, None, None)
+
+# Test 16: The gazetteer resolves exact, misspelled and prefix queries offline
+def test_gazetteer_lookup(tmp_path):
+    dump = tmp_path / "cities.txt"
+    rows = [
+        ["5128581", "New York City", "New York City", "", "40.71427", "-74.00597", "P", "PPL", "US"] + [""] * 5 + ["8804190"],
+        ["2988507", "Paris", "Paris", "", "48.85341", "2.3488", "P", "PPLC", "FR"] + [""] * 5 + ["2138551"],
+        ["4717560", "Paris", "Paris", "", "33.66094", "-95.55551", "P", "PPLA2", "US"] + [""] * 5 + ["24782"],
+        ["6255148", "Europe", "Europe", "", "48.69096", "9.14062", "L", "CONT", ""] + [""] * 5 + ["0"],
+    ]
+    dump.write_text("\n".join("\t".join(row) for row in rows), encoding="utf-8")
+    gazetteer = Gazetteer.from_geonames(str(dump))
+
+    assert len(gazetteer) == 3
+    assert gazetteer.lookup("paris")["display_name"] == "Paris, FR"
+    assert gazetteer.lookup("Pariss")["display_name"] == "Paris, FR"
+    assert gazetteer.lookup("New York Ciyt")["name"] == "New York City"
+    assert gazetteer.lookup("Europe") is None
+    assert [place["name"] for place in gazetteer.suggest("new")] == ["New York City"]
+
+# Test 17: IP geolocation is looked up once per client IP
+def test_get_current_location_cached_per_client(monkeypatch):
+    calls = []
+
+    def fake_get(url, **kwargs):
+        calls.append(url)
+        return FakeResponse({"city": "Denver", "loc": "39.7392,-104.9903"})
+
+    monkeypatch.setattr(weather_dashboard.http_client, "get", fake_get)
+    assert get_current_location("8.8.8.8") == ("Denver", 39.7392, -104.9903)
+    assert get_current_location("8.8.8.8") == ("Denver", 39.7392, -104.9903)
+    assert calls == ["https://ipinfo.io/8.8.8.8/json"]
+    # Private addresses fall back to the server's own location
+    get_current_location("192.168.1.20")
+    assert calls[-1] == "https://ipinfo.io/json"
+
+# Test 18: The local IP-range database answers without a network call
+def test_ip_range_database_lookup(tmp_path, monkeypatch):
+    ranges = tmp_path / "ip_city.csv"
+    ranges.write_text("start_ip,end_ip,city,lat,lon\n"
+                      "8.8.4.0,8.8.4.255,Mountain View,37.386,-122.0838\n"
+                      "1.1.1.0,1.1.1.255,Sydney,-33.8688,151.2093\n")
+    database = IPRangeDatabase.from_csv(str(ranges))
+    assert database.lookup("1.1.1.1") == ("Sydney", -33.8688, 151.2093)
+    assert database.lookup("8.8.8.8") is None
+    assert database.lookup("not an ip") is None
+
+    monkeypatch.setattr(geocoding, "_ip_database", database)
+    monkeypatch.setattr(weather_dashboard.http_client, "get", lambda *a, **k: pytest.fail("unexpected request"))
+    assert get_current_location("8.8.4.4") == ("Mountain View", 37.386, -122.0838)
+
+# Test 19: The user store imports the legacy CSV files once
+def test_user_store_migrates_csv(tmp_path):
+    fav_file = tmp_path / "favorites.csv"
+    settings_file = tmp_path / "settings.csv"
+    fav_file.write_text("user,city\nnoah,New York City\nsujay,Mumbai\nnoah,Paris\n")
+    settings_file.write_text('user,unit,sections,forecast_range\nnoah,Celsius,"Current Weather,Hourly Graph",36.0\n')
+
+    db = str(tmp_path / "users.db")
+    store = UserStore(db, str(fav_file), str(settings_file))
+    assert store.get_favorites("noah") == ["New York City", "Paris"]
+    assert store.get_settings("noah") == {"unit": "Celsius", "sections": ["Current Weather", "Hourly Graph"], "forecast_range": 36}
+    assert store.get_settings("nobody") is None
+    store.remove_favorite("noah", "Paris")
+    store.close()
+
+    # Reopening does not import the CSV again
+    store = UserStore(db, str(fav_file), str(settings_file))
+    assert store.get_favorites("noah") == ["New York City"]
+    store.close()
+
+# Test 20: Favorites keep their order and settings are only written when they change
+def test_user_store_point_updates(tmp_path):
+    store = UserStore(str(tmp_path / "users.db"), str(tmp_path / "none.csv"), str(tmp_path / "none.csv"))
+    assert store.add_favorite("amy", "Tokyo")
+    assert store.add_favorite("amy", "Lima")
+    assert not store.add_favorite("amy", "Tokyo")
+    assert store.get_favorites("amy") == ["Tokyo", "Lima"]
+    assert store.get_favorites("bob") == []
+
+    assert store.save_settings("amy", "Fahrenheit", ["Current Weather"], 12)
+    assert not store.save_settings("amy", "Fahrenheit", ["Current Weather"], 12)
+    assert store.save_settings("amy", "Celsius", ["Current Weather"], 12)
+    assert store.get_settings("amy")["unit"] == "Celsius"
+    store.close()
+
+# Test 21: Favorites overview fetches all cities in one bulk request
+def test_get_favorites_overview_bulk(monkeypatch):
+    places = {"Oslo": (59.91, 10.75), "Lima": (-12.05, -77.04), "Pune": (18.52, 73.86)}
+    for name, (lat, lon) in places.items():
+        geocoding.get_geocode_store().put(name, {"name": name, "lat": lat, "lon": lon, "display_name": name, "addresstype": "city"})
+
+    calls = []
+
+    def fake_get(url, params=None, **kwargs):
+        calls.append(params)
+        return fake_current_response(params)
+
+    monkeypatch.setattr(weather_dashboard.http_client, "get", fake_get)
+    overview, problems = get_favorites_overview(list(places), "celsius")
+
+    assert [(city, data["current"].temperature) for city, data in overview] == [("Oslo", 59.91), ("Lima", -12.05), ("Pune", 18.52)]
+    assert len(calls) == 1 and calls[0]["latitude"] == "59.91,-12.05,18.52"
+    assert problems == []
+    assert get_favorites_overview(list(places), "celsius") == (overview, []) and len(calls) == 1
+
+    # It may run off the script thread, so a failed lookup comes back as a message instead of being drawn
+    limiter = TokenBucket(rate=0.01, burst=1)
+    limiter.acquire(0)
+    monkeypatch.setattr(geocoding, "_geocoder", GeocodeScheduler(geocoding.get_geocode_store(), limiter=limiter, max_wait=0))
+    assert get_favorites_overview(["Quito"], "celsius") == ([], [("warning", "The geocoding service is busy. Please try again in a moment.")])
+
+# Test 22: The shared session retries rate limiting and server errors with capped backoff
+def test_http_client_retry_policy():
+    import http_client
+    adapter = http_client.session.get_adapter("https://api.open-meteo.com")
+    retry = adapter.max_retries
+    assert {429, 503}.issubset(retry.status_forcelist)
+    assert retry.backoff_jitter > 0
+    assert retry.get_retry_after(FakeRetryAfterResponse("120")) == http_client.MAX_RETRY_AFTER
+    assert http_client.session.headers["User-Agent"] == http_client.USER_AGENT
+
+# Test 23: The data plan only asks for what the selected sections show
+def test_plan_data_follows_sections():
+    plan = plan_data(["Current Weather", "Favorites Overview"])
+    assert plan.needs_forecast
+    assert plan.current and not plan.hourly and not plan.daily
+    assert not plan_data(["Favorites Overview"]).needs_forecast
+    assert "sunrise" not in plan_data(["7-Day Forecast"]).daily
+
+# Test 24: Hourly series are typed arrays windowed in the location's own time
+def test_hourly_series_window_respects_utc_offset():
+    hourly = {
+        "time": ["2025-04-01T00:00", "2025-04-01T01:00", "2025-04-01T02:00", "2025-04-01T03:00"],
+        "temperature_2m": [10.0, 11.5, None, 13.0],
+        "relative_humidity_2m": [80, 81, 82, 83],
+    }
+    series = HourlySeries.from_payload(hourly, utc_offset_seconds=-4 * 3600)
+    assert series.epochs.dtype.kind == "i" and series.temperature.dtype.name == "float32"
+    # Local midnight at UTC-4 is 04:00 UTC
+    assert series.epochs[0] == 1743480000
+    assert series.window(1743480000 + 1, 1743480000 + 2 * 3600) == (1, 3)
+    assert str(series.local_times(0, 1)[0]) == "2025-04-01T00:00:00"
+
+# Test 25: Hourly data is parsed once and reused until the forecast is refetched
+def test_hourly_series_shared_between_lookups(monkeypatch):
+    payload = {"timezone": "GMT", "utc_offset_seconds": 0,
+               "hourly": {"time": ["2025-04-01T00:00"], "temperature_2m": [1.0], "relative_humidity_2m": [50]}}
+    monkeypatch.setattr(weather_dashboard.http_client, "get", lambda *a, **k: FakeResponse(payload))
+    variables = plan_data(["Hourly Graph"]).variables()
+    first = cached_forecast(51.5, -0.12, "celsius", **variables)
+    second = cached_forecast(51.5, -0.12, "celsius", **variables)
+    assert first["hourly"] is second["hourly"]
+    assert len(first["hourly"]) == 1
+
+# Test 26: Each watched forecast is refreshed once per interval, however many sessions watch it
+def test_refresher_refreshes_each_key_once_per_interval():
+    now = [0.0]
+    refreshed = []
+    refresher = ForecastRefresher(lambda *key: refreshed.append(key), interval=600, idle_timeout=1800, clock=lambda: now[0])
+    refresher.start = lambda: None  # Drive it by hand instead of from the background thread
+
+    # Keys are (lat, lon, current, hourly, daily): sessions in either unit share one refresh
+    for _ in range(50):
+        refresher.watch((40.71, -74.01, ("temperature_2m",), (), ()))
+    refresher.watch((51.51, -0.13, ("temperature_2m",), (), ()))
+    assert refresher.run_once() == 0
+
+    now[0] = 601
+    assert refresher.run_once() == 2
+    assert refresher.run_once() == 0
+    assert sorted(refreshed) == [(40.71, -74.01, ("temperature_2m",), (), ()), (51.51, -0.13, ("temperature_2m",), (), ())]
+
+    # Forecasts nobody watches any more are dropped
+    now[0] = 2500
+    refresher.run_once()
+    assert refresher.watched() == []
+
+# Test 27: The dashboard renders offline against the stub upstream, and a rerun makes no upstream calls
+def test_dashboard_renders_offline_with_stub(tmp_path, monkeypatch):
+    from streamlit.testing.v1 import AppTest
+    from benchmarks.stub_upstream import UpstreamStub, install_app
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(storage, "_store", UserStore(str(tmp_path / "users.db"), "none.csv", "none.csv"))
+    stub = UpstreamStub()
+    uninstall = install_app(stub)
+    try:
+        at = AppTest.from_file(weather_dashboard.__file__, default_timeout=60)
+        at.query_params["email"] = "offline@example.com"
+        at.session_state["sections"] = ["Current Weather", "Hourly Graph", "Sunrise/Sunset", "7-Day Forecast"]
+        at.run()
+        assert not at.exception
+        assert [metric.label for metric in at.metric][:2] == ["Temperature", "Wind"]
+        assert stub.total_calls() == 3  # ipinfo, Nominatim and one forecast request
+
+        stub.reset()
+        at.run()
+        assert not at.exception
+        assert stub.total_calls() == 0
+    finally:
+        uninstall()
+
+# Test 28: Instrumented calls record spans, bytes and cache results as Prometheus metrics
+def test_metrics_spans_and_prometheus_text(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", True)
+    registry = metrics.Registry()
+    monkeypatch.setattr(metrics, "registry", registry)
+
+    @metrics.instrument("test.fetch")
+    def fetch():
+        metrics.add_bytes(512)
+        metrics.record_cache(False)
+        return "data"
+
+    trace = metrics.start_trace()
+    with metrics.span("test.rerun"):
+        assert fetch() == "data"
+    assert [(span.name, span.depth) for span in trace] == [("test.rerun", 0), ("test.fetch", 1)]
+
+    text = registry.render_prometheus()
+    assert 'weather_span_duration_seconds_count{span="test.fetch"} 1' in text
+    assert 'weather_span_bytes_total{span="test.fetch"} 512' in text
+    assert 'weather_span_cache_total{span="test.fetch",result="miss"} 1' in text
+
+# Test 29: With metrics disabled, instrumentation leaves functions untouched
+def test_metrics_disabled_is_free(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", False)
+
+    def fetch():
+        return "data"
+
+    assert metrics.instrument("test.fetch")(fetch) is fetch
+    assert metrics.start_trace() is None
+    with metrics.span("test.block") as span:
+        assert span is None
+
+# Test 30: Async fetches run side by side, and cached kinds are split from the ones still to fetch
+def test_async_fetches_overlap(monkeypatch):
+    import asyncio
+
+    def fake_get(url, params=None, **kwargs):
+        time.sleep(0.2)
+        return fake_current_response(params)
+
+    monkeypatch.setattr(weather_dashboard.http_client, "get", fake_get)
+    variables = plan_data(["Current Weather"]).current
+
+    async def fetch_both():
+        return await asyncio.gather(
+            weather_core.cached_forecast_async(10.0, 20.0, current=variables),
+            asyncio.to_thread(weather_core.fetch_overview, [("Lima", -12.05, -77.04), ("Pune", 18.52, 73.86)], "celsius"),
+        )
+
+    start = time.perf_counter()
+    forecast, overview = asyncio.run(fetch_both())
+    assert time.perf_counter() - start < 0.35
+    assert forecast["current"].temperature == 50.0
+    assert [(city, data["current"].temperature) for city, data in overview] == [("Lima", -12.05), ("Pune", 18.52)]
+
+    plan = plan_data(["Current Weather", "7-Day Forecast"])
+    assert weather_core.split_cached_kinds(10.0, 20.0, plan) == [
+        {"current": plan.current}, {"daily": plan.daily}]
+
+# Test 31: Forecasts are cached as compact read-only models that still convert back to the API's dicts
+def test_forecast_models_replace_raw_json(monkeypatch):
+    from forecast_models import CurrentConditions, DailySeries
+
+    def fake_get(url, params=None, **kwargs):
+        return FakeResponse({
+            "timezone": "GMT", "utc_offset_seconds": 0,
+            "current": {"temperature_2m": 70, "weather_code": 3},
+            "daily": {"time": ["2025-04-01", "2025-04-02"], "temperature_2m_max": [20.5, None], "weathercode": [61, 42]},
+        })
+
+    monkeypatch.setattr(weather_dashboard.http_client, "get", fake_get)
+    data = weather_core.cached_forecast(51.5, -0.13, current=("temperature_2m", "weather_code"), daily=("temperature_2m_max", "weathercode"))
+    assert isinstance(data["current"], CurrentConditions) and data["current"].weather == "Overcast ☁️"
+    daily = data["daily"]
+    assert isinstance(daily, DailySeries) and not daily.temperature_max.flags.writeable
+    assert list(daily.weather()) == ["Slight rain 🌦️", None]
+    assert daily.to_dict() == {"time": ["2025-04-01", "2025-04-02"], "temperature_2m_max": [68.9, None], "weathercode": [61, 42]}
+    assert get_7_day_forecast(51.5, -0.13, "fahrenheit")["daily"]["time"] == ["2025-04-01", "2025-04-02"]
+
+# Test 32: Bulk fetches are chunked, only fetch uncached points, and warm favorites plus popular searches
+def test_bulk_forecast_chunks_and_warming(tmp_path, monkeypatch):
+    calls = []
+
+    def fake_get(url, params=None, **kwargs):
+        calls.append(params)
+        return fake_current_response(params)
+
+    monkeypatch.setattr(weather_dashboard.http_client, "get", fake_get)
+    monkeypatch.setattr(weather_core, "BULK_CHUNK_SIZE", 2)
+    points = [(10.0, 1.0), (20.0, 2.0), (30.0, 3.0)]
+    results = weather_core.get_weather_bulk(points, "celsius")
+    assert [data["current"]["temperature_2m"] for data in results] == [10.0, 20.0, 30.0]
+    assert [params["latitude"] for params in calls] == ["10.0,20.0", "30.0"]
+
+    weather_core.get_weather_bulk(points + [(40.0, 4.0)])
+    assert calls[-1]["latitude"] == "40.0"  # Cached points aren't fetched again
+
+    store = UserStore(str(tmp_path / "users.db"), "none.csv", "none.csv")
+    store.add_favorite("amy", "Oslo")
+    monkeypatch.setattr(storage, "_store", store)
+    geocodes = geocoding.get_geocode_store()
+    for name, lat in (("Oslo", 59.91), ("Lima", -12.05), ("Pune", 18.52)):
+        geocodes.put(name, {"name": name, "lat": lat, "lon": 0.0, "display_name": name, "addresstype": "city"})
+    for query in ("lima", "Lima", "pune", "Nowhere"):
+        geocodes.record_search(query)
+    assert geocodes.top_searches(2) == ["lima", "nowhere"]
+
+    calls.clear()
+    assert weather_core.warm_forecasts() == 3
+    assert len(calls) == 2
+    assert sorted(calls[0]["latitude"].split(",") + calls[1]["latitude"].split(",")) == ["-12.05", "18.52", "59.91"]
+
+# Test 33: Forecasts survive a restart through the disk snapshot, and stale data is served while upstream is down
+def test_snapshot_restores_cache_and_serves_stale_data(tmp_path, monkeypatch):
+    import requests
+
+    calls = []
+
+    def fake_get(url, params=None, **kwargs):
+        calls.append(params)
+        return fake_current_response(params)
+
+    monkeypatch.setattr(weather_dashboard.http_client, "get", fake_get)
+    variables = plan_data(["Current Weather"]).current
+    weather_core.cached_forecast(48.85, 2.35, "celsius", current=variables)
+    weather_core.cached_forecast(59.91, 10.75, "celsius", current=variables)
+    # Make Oslo's forecast an hour old, so it's past its TTL when the snapshot comes back
+    dict(stale_forecast_cache.items())[(59.91, 10.75, "current", variables)]["fetched_at"] -= 3600
+
+    path = str(tmp_path / "snapshot.json.gz")
+    assert snapshot.ForecastSnapshot(path).save() == 2
+
+    # Restart: empty caches, then load the snapshot
+    forecast_cache.clear()
+    stale_forecast_cache.clear()
+    assert snapshot.ForecastSnapshot(path).load() == 2
+    assert weather_core.cached_forecast(48.85, 2.35, "celsius", current=variables)["current"].temperature == 48.85
+    assert len(calls) == 2  # Still fresh, so no new request
+
+    def failing_get(url, params=None, **kwargs):
+        raise requests.ConnectionError("upstream down")
+
+    monkeypatch.setattr(weather_dashboard.http_client, "get", failing_get)
+    data = weather_core.cached_forecast(59.91, 10.75, "celsius", current=variables)
+    assert data["stale"] and data["current"].temperature == 59.91
+    assert time.time() - data["fetched_at"] > 3600
+    assert weather_core.cached_forecast(1.0, 1.0, current=variables) is None
+
+# Test 34: The core module loads without the UI libraries, and the dashboard defers pandas until a section needs it
+def test_import_budget():
+    import subprocess
+    import sys
+
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import weather_core\n"
+        "elapsed = time.perf_counter() - start\n"
+        "heavy = sorted(m for m in ('pandas', 'plotly', 'streamlit') if m in sys.modules)\n"
+        "import weather_dashboard\n"
+        "print(elapsed, ','.join(heavy), 'pandas' in sys.modules)\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    elapsed, heavy, pandas_loaded = result.stdout.split(" ")
+    assert heavy == ""
+    assert pandas_loaded.strip() == "False"
+    assert float(elapsed) < 2.0  # Generous budget; requests and numpy alone take ~0.3s
+
+# Test 35: The token bucket spaces requests out and refuses waits longer than the timeout
+def test_token_bucket():
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    bucket = TokenBucket(rate=1.0, burst=2, clock=lambda: now[0], sleep=sleep)
+    assert bucket.acquire() and bucket.acquire()
+    assert sleeps == []
+    assert not bucket.acquire(timeout=0.5)
+    assert bucket.acquire(timeout=2)
+    assert sleeps == [1.0]
+
+# Test 36: The geocoder coalesces identical queries, remembers unknown names and suggests resolved places
+def test_geocode_scheduler(tmp_path):
+    store = GeocodeStore(str(tmp_path / "geocode.db"))
+    calls = []
+    release = threading.Event()
+
+    def fetch(query):
+        calls.append(query)
+        release.wait(5)
+        if query.lower().startswith("bos"):
+            return {"name": "Boston", "lat": "42.36", "lon": "-71.06", "display_name": "Boston, Massachusetts, United States",
+                    "addresstype": "city", "type": "administrative"}
+        return None
+
+    geocoder = GeocodeScheduler(store, fetch=fetch, limiter=TokenBucket(rate=1000, burst=10))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(geocoder.resolve("Boston"))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert calls == ["Boston"]
+    assert [location["name"] for location in results] == ["Boston"] * 5
+
+    assert geocoder.resolve("Invalid") is None
+    assert geocoder.resolve("  invalid") is None
+    assert calls == ["Boston", "Invalid"]
+
+    store.record_search("boston ma")
+    geocoder.resolve("Boston MA")
+    assert [place["display_name"] for place in geocoder.suggest("bo")] == ["Boston, Massachusetts, United States"]
+    assert geocoder.suggest("xyz") == []
+
+    # With no request slot free, the lookup gives up instead of queueing behind the rate limit
+    busy = GeocodeScheduler(store, fetch=fetch, limiter=TokenBucket(rate=0.01, burst=1), max_wait=0.1)
+    busy.resolve("Oslo")
+    with pytest.raises(RateLimited):
+        busy.resolve("Lima")
+
+    # Nominatim's session never repeats an error response behind the rate limiter's back
+    adapter = geocoding.nominatim_session.get_adapter(geocoding.NOMINATIM_URL)
+    assert adapter.max_retries.status == 0
+
+# Test 37: The forecast API serves compressed JSON with ETags, and the dashboard can read through it
+def test_forecast_api(monkeypatch):
+    import requests
+    import api_client
+    import forecast_api
+
+    server = forecast_api.start_api_server("127.0.0.1", 0)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    real_get = weather_dashboard.http_client.get
+    upstream = []
+    down = threading.Event()
+
+    def fake_get(url, params=None, **kwargs):
+        if url.startswith(base_url):
+            return real_get(url, params=params, **kwargs)
+        upstream.append(url)
+        if down.is_set():
+            raise requests.ConnectionError("upstream down")
+        if "nominatim" in url:
+            return FakeResponse([])
+        hours = [f"2025-04-01T{hour:02d}:00" for hour in range(24)]
+        return FakeResponse({"timezone": "GMT", "utc_offset_seconds": 0,
+                             "current": {"temperature_2m": 21.5},
+                             "hourly": {"time": hours, "temperature_2m": [10.0] * 24, "relative_humidity_2m": [50] * 24}})
+
+    monkeypatch.setattr(weather_dashboard.http_client, "get", fake_get)
+    try:
+        params = {"lat": "51.5", "lon": "-0.13", "sections": "Current Weather,Hourly Graph", "unit": "celsius"}
+        response = requests.get(f"{base_url}/forecast", params=params)
+        assert response.status_code == 200 and response.headers["Content-Encoding"] == "gzip"
+        assert response.json()["current"]["temperature_2m"] == 21.5
+        etag = response.headers["ETag"]
+        assert requests.get(f"{base_url}/forecast", params=params, headers={"If-None-Match": etag}).status_code == 304
+        assert requests.get(f"{base_url}/forecast", params={"lat": "1", "lon": "2", "sections": "Radar"}).status_code == 400
+        assert requests.get(f"{base_url}/forecast", params={"lat": "1", "lon": "2", "hourly": "precipitation"}).status_code == 400
+        assert requests.get(f"{base_url}/forecast", params={"city": "Invalid", "sections": "Current Weather"}).status_code == 404
+        only_temperature = requests.get(f"{base_url}/forecast", params={"lat": "1", "lon": "2", "hourly": "temperature_2m"})
+        assert only_temperature.status_code == 200 and only_temperature.json()["hourly"]["temperature_2m"][0] == 50.0
+
+        # A worker pointed at the API keeps no forecast cache of its own and revalidates what it has.
+        # The server runs in this process too, and still answers from its own cache.
+        monkeypatch.setattr(api_client, "API_URL", base_url)
+        variables = plan_data(["Hourly Graph"]).hourly
+        first = weather_core.cached_forecast(51.5, -0.13, hourly=variables)
+        assert first["hourly"].temperature[0] == 50.0
+        assert weather_core.cached_forecast(51.5, -0.13, hourly=variables)["hourly"] is first["hourly"]
+        assert len(forecast_cache) == 3  # Only the server's entries
+        assert upstream.count(weather_core.FORECAST_URL) == 2
+
+        # When the API can't answer, the worker keeps its last good copy
+        forecast_cache.clear()
+        stale_forecast_cache.clear()
+        down.set()
+        assert weather_core.cached_forecast(51.5, -0.13, hourly=variables)["hourly"] is first["hourly"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+# Test 38: Fetched hours are kept per location and read back by range, averaged for long ranges
+def test_history_store_ranges(tmp_path, monkeypatch):
+    import numpy as np
+
+    day = 24 * 3600
+    now = 1743552000  # 2025-04-02T00:00Z
+    store = HistoryStore(str(tmp_path / "ranges.db"), clock=lambda: now)
+    epochs = np.arange(now - day, now + day, 3600, dtype=np.int64)
+    series = HourlySeries(epochs, np.arange(48, dtype=np.float32), np.full(48, 50, dtype=np.float32))
+
+    # Only hours that have passed are recorded; a later fetch replaces them but keeps what it lacks
+    assert store.record(40.71, -74.01, series) == 25
+    assert store.record(40.71, -74.01, HourlySeries(epochs, np.arange(48, dtype=np.float32) + 100, None)) == 25
+    recorded = store.range(40.71, -74.01, now - day, now + 1)
+    assert len(recorded) == 25 and recorded.epochs[-1] == now
+    assert recorded.temperature[0] == 100.0 and recorded.humidity[0] == 50.0
+    assert len(store.range(51.51, -0.13, now - day, now + 1)) == 0
+
+    # Six-hour buckets average their hours
+    buckets = store.range(40.71, -74.01, now - day, now, step=6 * 3600)
+    assert len(buckets) == 4 and buckets.temperature[0] == 102.5
+
+    # A month for each of 50 locations; one location's 30 days come back in milliseconds
+    month = np.arange(now - 30 * day, now, 3600, dtype=np.int64)
+    for point in range(50):
+        store.record(float(point), 0.0, HourlySeries(month, np.zeros(len(month), dtype=np.float32), None))
+    start = time.perf_counter()
+    recorded = store.range(7.0, 0.0, now - 30 * day, now, history.bucket_seconds(now - 30 * day, now))
+    assert time.perf_counter() - start < 0.05
+    assert len(recorded) == history.MAX_POINTS
+
+    # Forecasts fetched through the cache are recorded, and read back in the display unit without a request
+    hours = [time.strftime("%Y-%m-%dT%H:00", time.gmtime(time.time() - 3600 * back)) for back in (2, 1)]
+    payload = {"timezone": "GMT", "utc_offset_seconds": 0,
+               "hourly": {"time": hours, "temperature_2m": [0.0, 10.0], "relative_humidity_2m": [40, 60]}}
+    monkeypatch.setattr(weather_dashboard.http_client, "get", lambda *a, **k: FakeResponse(payload))
+    weather_core.cached_forecast(48.85, 2.35, hourly=plan_data(["Hourly Graph"]).hourly)
+    monkeypatch.setattr(weather_dashboard.http_client, "get", lambda *a, **k: pytest.fail("unexpected request"))
+    past = weather_core.recorded_history(48.85, 2.35, time.time() - day, time.time(), "fahrenheit")
+    assert past.temperature.tolist() == [32.0, 50.0] and past.humidity.tolist() == [40.0, 60.0]
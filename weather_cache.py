@@ -0,0 +1,172 @@
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+# Streamlit re-executes weather_dashboard.py on every rerun, so anything that
+# has to be shared across reruns and sessions lives in this imported module.
+
+MISSING = object()
+
+
+class _Flight:
+    """One in-progress load that concurrent callers wait on."""
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """Thread-safe, size-bounded LRU cache with per-entry TTLs and single-flight loading."""
+
+    def __init__(self, max_entries=1024, clock=time.monotonic):
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, key):
+        # Caller must hold self._lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return MISSING
+        expires_at, value = entry
+        if expires_at <= self._clock():
+            del self._entries[key]
+            return MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            value = self._lookup(key)
+            if value is MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (self._clock() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def coalesce(self, key, loader):
+        # Run loader once for all concurrent callers asking for the same key
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+        return flight.value
+
+    def get_or_load(self, key, loader, ttl):
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+
+        def load():
+            # Another caller may have filled the entry while we waited for the lock
+            with self._lock:
+                value = self._lookup(key)
+            if value is not MISSING:
+                return value
+            value = loader()
+            # Failed loads (None) are not cached so the next caller retries
+            if value is not None:
+                self.set(key, value, ttl)
+            return value
+
+        return self.coalesce(key, load)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def items(self):
+        # (key, value) pairs of the live entries, least recently used first
+        with self._lock:
+            now = self._clock()
+            return [(key, value) for key, (expires_at, value) in self._entries.items() if expires_at > now]
+
+    def __contains__(self, key):
+        # A peek that doesn't count as a hit or miss or change the LRU order
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > self._clock()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Seconds each kind of forecast data stays fresh. Open-Meteo refreshes current
+# conditions every 15 minutes, while the daily outlook changes a few times a day.
+# All of them outlive the 10 minute background refresh, so watched entries never go cold.
+FORECAST_TTLS = {
+    "current": 15 * 60,
+    "hourly": 30 * 60,
+    "daily": 3 * 60 * 60,
+}
+
+# Coordinates are rounded to ~1 km so nearby lookups share entries
+COORDINATE_PRECISION = 2
+
+forecast_cache = TTLCache(max_entries=2048)
+
+# The last good forecast for each key, kept well past its TTL so it can be shown
+# (marked as stale) while the upstream is failing. Values are shared with forecast_cache.
+STALE_TTL = 24 * 60 * 60
+
+stale_forecast_cache = TTLCache(max_entries=4096)
+
+# IP geolocation results, keyed by client IP (None for the server's own address)
+LOCATION_TTL = 24 * 60 * 60
+
+location_cache = TTLCache(max_entries=4096)
+
+# Hourly chart figures, keyed by data version and chart window
+FIGURE_TTL = 60 * 60
+
+figure_cache = TTLCache(max_entries=256)
+
+metrics.registry.register_cache("forecast", forecast_cache)
+metrics.registry.register_cache("stale_forecast", stale_forecast_cache)
+metrics.registry.register_cache("location", location_cache)
+metrics.registry.register_cache("figure", figure_cache)
@@ -0,0 +1,407 @@
+import asyncio
+import ipaddress
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+
+import requests
+
+import api_client
+import http_client
+import metrics
+from forecast_models import model_from_payload
+from geocoding import get_geocode_store, get_geocoder, get_ip_database
+from history import get_history_store, bucket_seconds
+from refresher import get_refresher
+from snapshot import ensure_snapshot_loaded
+from storage import get_user_store
+from weather_cache import (forecast_cache, stale_forecast_cache, location_cache, FORECAST_TTLS, LOCATION_TTL,
+                           STALE_TTL, COORDINATE_PRECISION)
+
+logger = logging.getLogger(__name__)
+
+# The dashboard's data layer: IP geolocation, forecast fetching and caching, and the bulk
+# and async variants. It doesn't import Streamlit, pandas or plotly, so new worker
+# processes, the background threads and the tests load it quickly, and unlike the
+# dashboard script it isn't re-executed on every rerun.
+
+# Coordinates used when ipinfo.io cannot place the IP address
+DEFAULT_LOCATION = ("Hoboken", 40.7440, -74.0324)
+
+
+# Function to look up the location of an IP address (the server's own IP when None)
+@metrics.instrument("ipinfo.lookup")
+def lookup_ip_location(client_ip=None):
+    ip_database = get_ip_database()
+    if client_ip and ip_database is not None:
+        location = ip_database.lookup(client_ip)
+        if location is not None:
+            return location
+
+    ip_url = f"https://ipinfo.io/{client_ip}/json" if client_ip else "https://ipinfo.io/json"
+    try:
+        response = http_client.decode_json(http_client.get(ip_url))
+    except (requests.RequestException, ValueError):
+        return None  # Not cached, so the next session tries again
+    loc = response.get("loc", "").split(",")  # Get latitude, longitude
+    if len(loc) != 2:
+        return DEFAULT_LOCATION
+    city = response.get("city", "Hoboken")  # Default to "Hoboken" if city is not found
+    lat, lon = float(loc[0]), float(loc[1])
+    return city, lat, lon
+
+
+# Function to get the user's current location based on IP
+@metrics.instrument("get_current_location")
+def get_current_location(client_ip=None):
+    # Private and loopback addresses can't be geolocated, so fall back to the server's IP
+    if client_ip and not ipaddress.ip_address(client_ip).is_global:
+        client_ip = None
+    location = location_cache.get_or_load(client_ip, lambda: lookup_ip_location(client_ip), LOCATION_TTL)
+    return location or DEFAULT_LOCATION
+
+
+# Place types accepted as a city; anything else (a street, a shop) is rejected
+CITY_TYPES = ('city', 'town', 'village', 'administrative', 'municipality', 'state', 'province')
+
+
+# Function to check that a geocoding result is actually a city and not a region or street
+def is_city(location, query):
+    return (location.get('addresstype') in CITY_TYPES or location.get('name') == query
+            or location.get('type') in CITY_TYPES)
+
+
+# Variables requested from Open-Meteo for each dashboard section
+SECTION_VARIABLES = {
+    "Current Weather": {
+        "current": ("temperature_2m", "relative_humidity_2m", "wind_speed_10m", "apparent_temperature", "weather_code"),
+    },
+    "Hourly Graph": {
+        "hourly": ("temperature_2m", "relative_humidity_2m"),
+    },
+    "Sunrise/Sunset": {
+        "daily": ("sunrise", "sunset"),
+    },
+    "7-Day Forecast": {
+        "daily": ("temperature_2m_max", "temperature_2m_min", "precipitation_probability_max", "weathercode"),
+    },
+}
+
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+
+# Locations per bulk Open-Meteo request, well inside its per-request location and URL length limits
+BULK_CHUNK_SIZE = 100
+
+# What the cache warmer prefetches: these sections' cache keys don't depend on what else a
+# session selected, for every favorite plus the most searched cities
+WARM_SECTIONS = ("Current Weather", "Hourly Graph")
+WARM_TOP_SEARCHES = 20
+
+
+@dataclass(frozen=True)
+class DataPlan:
+    """The forecast variables one rerun needs, worked out from the selected sections before any I/O."""
+    current: tuple = ()
+    hourly: tuple = ()
+    daily: tuple = ()
+
+    @property
+    def needs_forecast(self):
+        return bool(self.current or self.hourly or self.daily)
+
+    def variables(self):
+        return {"current": self.current, "hourly": self.hourly, "daily": self.daily}
+
+
+# Function to work out which current/hourly/daily variables the selected sections need
+def section_variables(sections):
+    variables = {"current": [], "hourly": [], "daily": []}
+    for section in sections:
+        for kind, names in SECTION_VARIABLES.get(section, {}).items():
+            variables[kind].extend(name for name in names if name not in variables[kind])
+    return {kind: tuple(names) for kind, names in variables.items()}
+
+
+# Function to build the data plan for the selected sections
+def plan_data(sections):
+    return DataPlan(**section_variables(sections))
+
+
+# Function to fetch any mix of current/hourly/daily variables in one Open-Meteo request.
+# No unit parameters are sent, so the data comes in Open-Meteo's defaults (celsius, km/h)
+# and one cache entry serves sessions in either unit.
+@metrics.instrument("open_meteo.fetch")
+def fetch_forecast(lat, lon, current=(), hourly=(), daily=()):
+    params = {
+        "latitude": lat,
+        "longitude": lon,
+        "timezone": "auto",
+    }
+    if current:
+        params["current"] = ",".join(current)
+    if hourly:
+        params["hourly"] = ",".join(hourly)
+    if daily:
+        params["daily"] = ",".join(daily)
+
+    try:
+        response = http_client.get(FORECAST_URL, params=params)
+    except requests.RequestException:
+        return None
+    if response.status_code == 200:
+        return http_client.decode_json(response)
+    return None
+
+
+# Function to split a forecast response into per-kind cache entries
+def store_forecast(lat, lon, requested, fetched):
+    # Parsed once here and shared read-only by every session showing this location;
+    # the raw JSON isn't kept
+    fetched_at = time.time()
+    version = (lat, lon, fetched_at)
+    utc_offset_seconds = fetched.get("utc_offset_seconds", 0)
+    parts = {}
+    for kind, names in requested.items():
+        part = {
+            "model": model_from_payload(kind, fetched.get(kind), utc_offset_seconds, version),
+            "timezone": fetched.get("timezone", "GMT"),
+            "utc_offset_seconds": utc_offset_seconds,
+            "fetched_at": fetched_at,
+        }
+        forecast_cache.set((lat, lon, kind, names), part, FORECAST_TTLS[kind])
+        # Kept for a day as a fallback (and in the disk snapshot) for when the upstream is down
+        stale_forecast_cache.set((lat, lon, kind, names), part, STALE_TTL)
+        parts[kind] = part
+
+    # The hours that have already passed are kept for the past-vs-forecast chart
+    hourly = parts.get("hourly")
+    if hourly is not None and hourly["model"] is not None:
+        try:
+            get_history_store().record(lat, lon, hourly["model"])
+        except sqlite3.Error:
+            logger.exception("Recording hourly history for %s, %s failed", lat, lon)
+    return parts
+
+
+# Function to refetch a forecast and replace its cache entries (used by the background refresher)
+def refresh_forecast(lat, lon, current=(), hourly=(), daily=()):
+    requested = {kind: names for kind, names in (("current", current), ("hourly", hourly), ("daily", daily)) if names}
+    fetched = fetch_forecast(lat, lon, **requested)
+    if fetched is not None:
+        store_forecast(lat, lon, requested, fetched)
+
+
+# Function to keep a forecast fresh in the background while sessions are viewing it
+def watch_forecast(lat, lon, current=(), hourly=(), daily=()):
+    if api_client.API_URL:
+        return  # The forecast API process keeps what it serves fresh
+    watch_local_forecast(lat, lon, current, hourly, daily)
+
+
+# Function to keep a forecast in this process's own cache fresh, whatever API_URL says
+def watch_local_forecast(lat, lon, current=(), hourly=(), daily=()):
+    lat, lon = round(lat, COORDINATE_PRECISION), round(lon, COORDINATE_PRECISION)
+    get_refresher(refresh_forecast).watch((lat, lon, tuple(current), tuple(hourly), tuple(daily)))
+
+
+# Function to get the hours recorded for a location between two UTC instants, in the display
+# unit; long ranges come back averaged into wider buckets, so a chart never gets too many points
+@metrics.instrument("recorded_history")
+def recorded_history(lat, lon, start, end, unit='fahrenheit', utc_offset_seconds=0):
+    lat, lon = round(lat, COORDINATE_PRECISION), round(lon, COORDINATE_PRECISION)
+    series = get_history_store().range(lat, lon, start, end, bucket_seconds(start, end), utc_offset_seconds)
+    return series.in_units(unit)
+
+
+# Function to look up each requested kind in the cache; returns (cached parts, missing kinds)
+def cached_parts(lat, lon, requested):
+    parts, missing = {}, {}
+    for kind, names in requested.items():
+        if not names:
+            continue
+        part = forecast_cache.get((lat, lon, kind, names), None)
+        if part is None:
+            missing[kind] = names
+        else:
+            parts[kind] = part
+    return parts, missing
+
+
+# Function to find the last good data for the missing kinds, or None if any of them has none
+def stale_parts(lat, lon, missing):
+    parts = {}
+    for kind, names in missing.items():
+        part = stale_forecast_cache.get((lat, lon, kind, names), None)
+        if part is None:
+            return None
+        parts[kind] = part
+    return parts
+
+
+# Function to get a cached part's model in the display unit. Each unit's copy is made once and
+# kept on the cache entry, so unit toggles and reruns reuse it and never touch the network.
+def display_model(part, unit):
+    views = part.setdefault("views", {})
+    model = views.get(unit)
+    if model is None and part["model"] is not None:
+        model = views[unit] = part["model"].in_units(unit)
+    return model
+
+
+# Function to merge cached parts into the dict the sections read, in the display unit
+def forecast_data(parts, unit='fahrenheit'):
+    data = {}
+    now = time.time()
+    for kind, part in parts.items():
+        data[kind] = display_model(part, unit)
+        data["timezone"] = part["timezone"]
+        data["utc_offset_seconds"] = part["utc_offset_seconds"]
+        # When the oldest part was fetched, and whether it's past its TTL (served during an outage)
+        data["fetched_at"] = min(part["fetched_at"], data.get("fetched_at", now))
+        data["stale"] = data.get("stale", False) or now - part["fetched_at"] > FORECAST_TTLS[kind]
+    return data
+
+
+# Function to fetch forecast data through the shared cache, one entry per data kind
+@metrics.instrument("cached_forecast")
+def cached_forecast(lat, lon, unit='fahrenheit', current=(), hourly=(), daily=()):
+    if api_client.API_URL:
+        # A shared forecast API process owns the cache; this one only keeps ETags
+        lat, lon = round(lat, COORDINATE_PRECISION), round(lon, COORDINATE_PRECISION)
+        return api_client.get_api_client().forecast(lat, lon, unit, current, hourly, daily)
+    return local_forecast(lat, lon, unit, current, hourly, daily)
+
+
+# Function to fetch forecast data through this process's own cache, whatever API_URL says
+# (the forecast API serves from this, so it can never call itself)
+def local_forecast(lat, lon, unit='fahrenheit', current=(), hourly=(), daily=()):
+    lat, lon = round(lat, COORDINATE_PRECISION), round(lon, COORDINATE_PRECISION)
+    requested = {"current": tuple(current), "hourly": tuple(hourly), "daily": tuple(daily)}
+
+    ensure_snapshot_loaded()
+    parts, missing = cached_parts(lat, lon, requested)
+    metrics.record_cache(not missing)
+    if missing:
+        # Concurrent sessions asking for the same thing share one upstream call
+        request_key = (lat, lon) + tuple(sorted(missing.items()))
+        fetched = forecast_cache.coalesce(request_key, lambda: fetch_forecast(lat, lon, **missing))
+        if fetched is not None:
+            parts.update(store_forecast(lat, lon, missing, fetched))
+        else:
+            # Upstream failed: fall back to the last good data, if there is any
+            stale = stale_parts(lat, lon, missing)
+            if stale is None:
+                return None
+            parts.update(stale)
+    return forecast_data(parts, unit)
+
+
+# Function to fetch several locations with one request per BULK_CHUNK_SIZE of them;
+# returns one response (or None) per point, in order
+@metrics.instrument("open_meteo.fetch_bulk")
+def fetch_forecast_bulk(points, current=(), hourly=(), daily=()):
+    results = []
+    for start in range(0, len(points), BULK_CHUNK_SIZE):
+        chunk = points[start:start + BULK_CHUNK_SIZE]
+        # Open-Meteo takes comma-separated coordinate lists
+        fetched = fetch_forecast(",".join(str(lat) for lat, lon in chunk), ",".join(str(lon) for lat, lon in chunk),
+                                 current, hourly, daily)
+        # One location comes back as an object, several as a list in request order
+        if isinstance(fetched, dict):
+            fetched = [fetched]
+        if fetched is None or len(fetched) != len(chunk):
+            fetched = [None] * len(chunk)
+        results.extend(fetched)
+    return results
+
+
+# Function to get forecast data for many locations through the shared cache, fetching
+# only the locations that aren't cached yet; returns one dict (or None) per point
+@metrics.instrument("cached_forecast_bulk")
+def cached_forecast_bulk(points, unit='fahrenheit', current=(), hourly=(), daily=()):
+    if api_client.API_URL:
+        return [cached_forecast(lat, lon, unit, current, hourly, daily) for lat, lon in points]
+    return local_forecast_bulk(points, unit, current, hourly, daily)
+
+
+# Function to get forecast data for many locations through this process's own cache
+def local_forecast_bulk(points, unit='fahrenheit', current=(), hourly=(), daily=()):
+    ensure_snapshot_loaded()
+    points = [(round(lat, COORDINATE_PRECISION), round(lon, COORDINATE_PRECISION)) for lat, lon in points]
+    requested = {kind: tuple(names) for kind, names in (("current", current), ("hourly", hourly), ("daily", daily)) if names}
+
+    results, missing = {}, []
+    for point in dict.fromkeys(points):
+        parts, missing_kinds = cached_parts(*point, requested)
+        if missing_kinds:
+            missing.append(point)
+        else:
+            results[point] = forecast_data(parts, unit)
+
+    metrics.record_cache(not missing)
+    if missing:
+        request_key = (tuple(requested.items()), tuple(missing))
+        fetched = forecast_cache.coalesce(request_key, lambda: fetch_forecast_bulk(missing, **requested))
+        for point, payload in zip(missing, fetched):
+            if payload is not None:
+                results[point] = forecast_data(store_forecast(*point, requested, payload), unit)
+            else:
+                stale = stale_parts(*point, requested)
+                if stale is not None:
+                    results[point] = forecast_data(stale, unit)
+    return [results.get(point) for point in points]
+
+
+# Function to prefetch every favorite city and the most searched ones in a few bulk requests
+# (run by the background cache warmer)
+def warm_forecasts():
+    geocodes = get_geocode_store()
+    geocoder = get_geocoder()
+    cities = dict.fromkeys(get_user_store().all_favorites() + geocodes.top_searches(WARM_TOP_SEARCHES))
+
+    # Only cities geocoded before; the warmer never queues Nominatim lookups
+    points = []
+    for city in cities:
+        location = geocoder.cached(city)
+        if location is not None:
+            points.append((float(location["lat"]), float(location["lon"])))
+
+    # Always this process's cache: with a forecast API configured, only that process warms
+    local_forecast_bulk(points, **plan_data(WARM_SECTIONS).variables())
+    return len(points)
+
+
+# Async versions of the fetchers. They run the pooled, retrying http_client path on
+# worker threads, so awaiting several together keeps all their requests in flight at once.
+async def cached_forecast_async(lat, lon, unit='fahrenheit', current=(), hourly=(), daily=()):
+    return await asyncio.to_thread(cached_forecast, lat, lon, unit, current, hourly, daily)
+
+
+# Function to group a plan's forecast kinds into those already cached and those still to fetch
+def split_cached_kinds(lat, lon, plan):
+    lat, lon = round(lat, COORDINATE_PRECISION), round(lon, COORDINATE_PRECISION)
+    cached, missing = {}, {}
+    for kind, names in plan.variables().items():
+        if names:
+            group = cached if (lat, lon, kind, names) in forecast_cache else missing
+            group[kind] = names
+    return [group for group in (cached, missing) if group]
+
+
+# Function to turn cached forecast models back into the API's dict shape
+def forecast_dict(data):
+    return {key: value.to_dict() if hasattr(value, "to_dict") else value for key, value in data.items()}
+
+
+# Function to get the current weather data for many (lat, lon) points; one dict (or None) per point
+def get_weather_bulk(points, unit='fahrenheit'):
+    results = cached_forecast_bulk(points, unit, current=SECTION_VARIABLES["Current Weather"]["current"])
+    return [forecast_dict(data) if data is not None else None for data in results]
+
+
+# Function to fetch current conditions for already geocoded favorites, all in one bulk request
+def fetch_overview(located, unit='fahrenheit'):
+    results = cached_forecast_bulk([(lat, lon) for city, lat, lon in located], unit,
+                                   current=SECTION_VARIABLES["Current Weather"]["current"])
+    return [(city, data) for (city, lat, lon), data in zip(located, results)]
@@ -1,54 +1,103 @@
 import streamlit as st
 import requests
-import pandas as pd
-from datetime import datetime, timedelta
-import plotly.express as px
-import os
-from streamlit_autorefresh import st_autorefresh
-
-# Function to get the user's current location based on IP
-def get_current_location():
-    ip_url = "https://ipinfo.io/json"
-    response = requests.get(ip_url).json()
-    city = response.get("city", "Hoboken")  # Default to "Hoboken" if city is not found
-    loc = response.get("loc", "").split(",")  # Get latitude, longitude
-    lat, lon = float(loc[0]), float(loc[1])
-    return city, lat, lon
+from datetime import datetime, timezone
+import time
+import ipaddress
+import asyncio
+from weather_cache import figure_cache, FIGURE_TTL
+from refresher import get_warmer, REFRESH_INTERVAL
+from geocoding import get_geocode_store, get_geocoder, GeocodingError, RateLimited
+from storage import get_user_store
+from weather_core import (SECTION_VARIABLES, get_current_location, is_city, section_variables, plan_data,
+                          watch_forecast, cached_forecast, forecast_dict, split_cached_kinds, cached_forecast_async,
+                          fetch_overview, recorded_history, warm_forecasts)
+import api_client
+import http_client
+import metrics
+
+# pandas and plotly are imported by the sections that draw with them, so a session that
+# only sees the login prompt (and a fresh worker process) doesn't pay for loading them
+
+
+# Function to get the browser's IP address from the proxy headers, if there are any
+def get_client_ip():
+    headers = st.context.headers
+    forwarded = headers.get("X-Forwarded-For")
+    if forwarded:
+        client_ip = forwarded.split(",")[0].strip()
+    else:
+        client_ip = headers.get("X-Real-Ip")
+    try:
+        ipaddress.ip_address(client_ip)
+    except (TypeError, ValueError):
+        return None
+    return client_ip
+
+
+# Function to pick the city shown when a session starts
+def get_default_city(user):
+    """
+    Resolved once per session: the user's first favorite if they have one,
+    otherwise the city of their IP address.
+    """
+    if "default_city" not in st.session_state:
+        user_favorites = get_user_store().get_favorites(user)
+        if user_favorites:
+            st.session_state.default_city = user_favorites[0]
+        else:
+            city_name, lat, lon = get_current_location(get_client_ip())
+            st.session_state.default_city = city_name
+    return st.session_state.default_city
+
+
+# Function to look up a city through the shared geocoding scheduler without drawing anything,
+# so it can also run off the script thread
+def find_city(city_name):
+    """
+    Returns ((lat, lon, address) or None, problem), where problem is None or a
+    ("warning" | "error", message) pair for the caller to show on the page.
+    """
+    try:
+        location = get_geocoder().resolve(city_name)
+    except RateLimited:
+        return None, ("warning", "The geocoding service is busy. Please try again in a moment.")
+    except GeocodingError as e:
+        return None, ("error", f"API request failed with status code {e.status_code}: {e.text}")
+    except requests.RequestException as e:
+        return None, ("error", f"Could not reach the geocoding service: {e}")
+
+    if location is None:
+        return None, None
+    # Check if the type of location is a city or town
+    if not is_city(location, city_name):
+        return None, ("warning", f"City '{city_name}' not found. Please try a valid city.")
+    return (float(location['lat']), float(location['lon']), location['display_name']), None
+
+
+# Function to show a problem reported by find_city
+def show_problem(problem):
+    level, message = problem
+    if level == "warning":
+        st.warning(message)
+    else:
+        st.error(message)
 
 
 # Function to get the coordinates for a given city
+@metrics.instrument("get_coordinates")
 def get_coordinates(city_name):
-    url = f"https://nominatim.openstreetmap.org/search?q={city_name}&format=json&limit=1"
-    headers = {"User-Agent": "WeatherDashboardApp/ (noahjacobkurian@gmail.com)"}
-    response = requests.get(url, headers=headers)
-
-    if response.status_code == 200:
-        location_data = response.json()
-        if location_data:
-
-            # Ensure that the result is actually a city and not a region or street
-            location = location_data[0]
-            
-            valid_types = ['city', 'town', 'village', 'administrative', 'municipality', 'state', 'province']
-
-            # Check if the type of location is a city or town
-            if location['addresstype'] in valid_types or location['name'] == city_name or location['type'] in valid_types:
-                full_address = location['display_name']
-                return float(location['lat']), float(location['lon']), full_address
-            else:
-                st.warning(f"City '{city_name}' not found. Please try a valid city.")
-                return None, None, None
-    else:
-        st.error(f"API request failed with status code {response.status_code}: {response.text}")
-        return None, None, None
+    get_geocode_store().record_search(city_name)
+    place, problem = find_city(city_name)
+    if problem:
+        show_problem(problem)
+    return place or (None, None, None)
 
 
 # Function to get the current weather data for a given lat, lon
 def get_weather(lat, lon, unit='fahrenheit'):
-    url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,wind_speed_10m,apparent_temperature,weather_code&wind_speed_unit=mph&temperature_unit={unit}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json()
+    data = cached_forecast(lat, lon, unit, current=SECTION_VARIABLES["Current Weather"]["current"])
+    if data is not None:
+        return forecast_dict(data)
     else:
         st.error("Failed to retrieve current weather data.")
         return None
@@ -56,22 +105,22 @@ def get_weather(lat, lon, unit='fahrenheit'):
 
 # Function to get the hourly weather data for a given lat, lon
 def get_hourly_weather(lat, lon, unit='fahrenheit'):
-    url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&hourly=temperature_2m,relative_humidity_2m&temperature_unit={unit}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json()["hourly"]
+    data = cached_forecast(lat, lon, unit, hourly=SECTION_VARIABLES["Hourly Graph"]["hourly"])
+    if data is not None:
+        return forecast_dict(data)["hourly"]
     else:
         st.error("Failed to retrieve hourly forecast data.")
         return None
 
 
 # Function to display current weather metrics
+@metrics.instrument("display.current_weather")
 def display_current_weather(current, unit):
     unit = unit[0].upper()
-    temp = f"{current['temperature_2m']}°{unit}"
-    wind = f"{current['wind_speed_10m']} mph"
-    humidity = f"{current['relative_humidity_2m']}%"
-    feels_like = f"{current['apparent_temperature']}°{unit}"
+    temp = f"{current.temperature}°{unit}"
+    wind = f"{current.wind_speed} mph"
+    humidity = f"{current.humidity}%"
+    feels_like = f"{current.apparent_temperature}°{unit}"
 
     a, b = st.columns(2)
     c, d = st.columns(2)
@@ -83,47 +132,92 @@ def display_current_weather(current, unit):
     d.metric("Feels Like", feels_like, border=True)
 
 
-# Function to display hourly weather trends
-def display_hourly_weather(hourly_weather, unit, hours):
-    # Convert data to DataFrame for visualization
-    df = pd.DataFrame({
-        "Time": pd.to_datetime(hourly_weather["time"]),  # Convert timestamps
-        "Temperature": hourly_weather["temperature_2m"],
-        "Humidity": hourly_weather["relative_humidity_2m"]
-    })
-    current_time = datetime.now()
-    future_time = current_time + timedelta(hours=hours)
-
-    # Filter the DataFrame to only include data within the next 12 hours
-    df = df[(df["Time"] >= current_time) & (df["Time"] <= future_time)]
+# Function to geocode the favorites and keep their current conditions fresh in the background;
+# returns the (city, lat, lon) found and any problems to show, as it may run off the script thread
+def locate_favorites(cities):
+    # One city at a time: results are usually cached, and Nominatim allows only 1 request/s
+    located, problems = [], []
+    for city in cities:
+        place, problem = find_city(city)
+        if place is not None:
+            lat, lon, address = place
+            located.append((city, lat, lon))
+            watch_forecast(lat, lon, current=SECTION_VARIABLES["Current Weather"]["current"])
+        if problem:
+            problems.append(problem)
+    return located, problems
+
+
+# Function to fetch current conditions for several cities at once; returns (overview, problems)
+@metrics.instrument("get_favorites_overview")
+def get_favorites_overview(cities, unit='fahrenheit'):
+    located, problems = locate_favorites(cities)
+    return (fetch_overview(located, unit) if located else []), problems
+
+
+# Function to display current conditions for every favorite as a compact grid
+@metrics.instrument("display.favorites_overview")
+def display_favorites_overview(overview, unit):
+    unit = unit[0].upper()
+    st.markdown("### ⭐ Favorites Overview")
+    columns = st.columns(3)
+    for i, (city, data) in enumerate(overview):
+        with columns[i % 3]:
+            if data and data.get("current"):
+                current = data["current"]
+                st.metric(city, f"{current.temperature}°{unit}", border=True)
+                st.caption(f"💨 {current.wind_speed} mph · 💧 {current.humidity}%")
+                if data["stale"]:
+                    st.caption(f"⚠️ As of {last_updated(data):%I:%M %p}")
+            else:
+                st.metric(city, "N/A", border=True)
 
-    # Split 'Time' into 'Date' and 'Hour' for easier use in the tooltip
-    df["Date"] = df["Time"].dt.strftime("%b %d, %Y")
-    df["Hour"] = df["Time"].dt.strftime("%I:%M %p")  # Format as Hour:Minute
 
-    # Plot the chart using Plotly
-    fig = px.line(df, x="Time", y=["Temperature", "Humidity"], title="Hourly Temperature & Humidity Trend")
+# Line colours, shared by the forecast and the recorded hours of each measure
+TEMPERATURE_COLOR = "#636efa"
+HUMIDITY_COLOR = "#ef553b"
 
-    # Update hover template for Temperature
-    unit = unit[0].upper()
-    df["Unit"] = unit
-    fig.update_traces(
-        hovertemplate="Temperature: <b>%{y}°%{customdata[1]}</b><br>Date: %{customdata[0]}<br>",
-        selector=dict(name="Temperature"),
 
-        customdata=df[["Date", "Unit"]],
+# Function to build the hourly trend chart for points i to j of the series, with the
+# recorded past hours (another HourlySeries) drawn dotted before them
+@metrics.instrument("build_hourly_figure")
+def build_hourly_figure(series, unit, i, j, past=None):
+    import plotly.graph_objects as go
 
-    )
+    unit = unit[0].upper()
+    times = series.local_times(i, j)
+
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=times, y=series.temperature[i:j], mode="lines", name="Temperature", line=dict(color=TEMPERATURE_COLOR),
+        hovertemplate=f"Temperature: <b>%{{y:.1f}}°{unit}</b><br>Date: %{{x|%b %d, %Y}}<br><extra></extra>",
+    ))
+    fig.add_trace(go.Scatter(
+        x=times, y=series.humidity[i:j], mode="lines", name="Humidity", line=dict(color=HUMIDITY_COLOR),
+        hovertemplate="Humidity: <b>%{y:.0f}%</b><br>Date: %{x|%b %d, %Y}<br><extra></extra>",
+    ))
+
+    # First and last instants drawn, to pick the tick format
+    first, last = (series.epochs[i], series.epochs[j - 1]) if i < j else (None, None)
+    if past is not None and len(past):
+        past_times = past.local_times(0, len(past))
+        fig.add_trace(go.Scatter(
+            x=past_times, y=past.temperature, mode="lines", name="Recorded Temperature",
+            line=dict(color=TEMPERATURE_COLOR, dash="dot"),
+            hovertemplate=f"Recorded: <b>%{{y:.1f}}°{unit}</b><br>Date: %{{x|%b %d, %H:%M}}<br><extra></extra>",
+        ))
+        fig.add_trace(go.Scatter(
+            x=past_times, y=past.humidity, mode="lines", name="Recorded Humidity",
+            line=dict(color=HUMIDITY_COLOR, dash="dot"),
+            hovertemplate="Recorded: <b>%{y:.0f}%</b><br>Date: %{x|%b %d, %H:%M}<br><extra></extra>",
+        ))
+        first, last = past.epochs[0], past.epochs[-1] if last is None else last
 
-    # Update hovertemplate for Humidity
-    fig.update_traces(
-        hovertemplate="Humidity: <b>%{y}%</b><br>Date: %{customdata[0]}<br>",
-        selector=dict(name="Humidity"),
-        customdata=df[["Date"]]
-    )
     fig.update_layout(
+        title="Hourly Temperature & Humidity Trend",
         xaxis=dict(
-            tickformat="%H:%M",
+            # Times of day for up to two days, dates beyond that
+            tickformat="%H:%M" if first is None or last - first <= 48 * 3600 else "%b %d",
             title="Time"
         ),
         yaxis=dict(
@@ -132,89 +226,83 @@ def display_hourly_weather(hourly_weather, unit, hours):
         legend_title="Legend",
         hovermode="x"
     )
+    return fig
 
+
+# Function to display hourly weather trends
+@metrics.instrument("display.hourly_weather")
+def display_hourly_weather(series, unit, hours, lat=None, lon=None, past_hours=0):
+    # The series is in UTC epochs, so the window is right whatever the server's timezone
+    now = time.time()
+    i, j = series.window(now, now + hours * 3600)
+
+    def build():
+        past = None
+        if past_hours and lat is not None:
+            # Read from the local history store, never from the upstream API
+            past = recorded_history(lat, lon, now - past_hours * 3600, now, unit, series.utc_offset_seconds)
+        return build_hourly_figure(series, unit, i, j, past)
+
+    # The window only moves on the hour, and history is only recorded when the series is
+    # refetched, so reruns and slider moves reuse a cached figure
+    key = (series.version, unit, hours, past_hours, i, j)
+    fig = figure_cache.get_or_load(key, build, FIGURE_TTL)
     st.plotly_chart(fig)
 
 def get_7_day_forecast(lat, lon, unit='metric'):
-    url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&daily=temperature_2m_max,temperature_2m_min,precipitation_probability_max,weathercode&temperature_unit={unit}&timezone=auto"
-    response = requests.get(url)
-
-
-    if response.status_code == 200:
-        return response.json()
-
+    data = cached_forecast(lat, lon, unit, daily=SECTION_VARIABLES["7-Day Forecast"]["daily"])
+    if data is not None:
+        return forecast_dict(data)
     else:
         st.error("Failed to fetch forecast data.")
         return None
 
-def display_7_day_forecast(lat, lon, unit):
-    forecast_data = get_7_day_forecast(lat, lon, unit)
-    daily_data = forecast_data["daily"]
-
-
-    df = pd.DataFrame({
-            "Date": pd.to_datetime(daily_data["time"]).strftime('%A, %b %d'),
-            "Max Temp": daily_data["temperature_2m_max"],
-            "Min Temp ": daily_data["temperature_2m_min"],
-            "Precipitation Probability (%)": daily_data["precipitation_probability_max"],
-            "Weather Code": daily_data["weathercode"]
+# Function to build the 7-day table from a daily series
+def build_daily_table(daily):
+    import pandas as pd
+
+    table = pd.DataFrame({
+            "Date": [day.strftime('%A, %b %d') for day in daily.dates.astype(object)],
+            "Max Temp": daily.temperature_max,
+            "Min Temp ": daily.temperature_min,
+            "Precipitation Probability (%)": daily.precipitation_probability,
+            # Weather codes as text and icons, from the precomputed lookup table
+            "Weather": daily.weather(),
     })
+    table.index = table.index + 1
+    return table
 
 
-    weather_code_mapping = {
-                0: "Clear sky ☀️",
-                1: "Mainly clear 🌤️",
-                2: "Partly cloudy ⛅",
-                3: "Overcast ☁️",
-                45: "Fog 🌫️",
-                48: "Depositing rime fog 🌫️",
-                51: "Light drizzle 🌦️",
-                53: "Moderate drizzle 🌧️",
-                55: "Dense drizzle 🌧️",
-                61: "Slight rain 🌦️",
-                63: "Moderate rain 🌧️",
-                65: "Heavy rain 🌧️",
-                71: "Slight snow fall ❄️",
-                73: "Moderate snow fall ❄️",
-                75: "Heavy snow fall ❄️",
-                80: "Slight rain showers 🌦️",
-                81: "Moderate rain showers 🌧️",
-                82: "Violent rain showers ⛈️",
-                95: "Thunderstorm ⛈️",
-                96: "Thunderstorm with slight hail ⛈️",
-                99: "Thunderstorm with heavy hail ⛈️"
-            }
-
-    # Replacing 'Weather Code' numbers with text and Icons
-    df["Weather"] = df["Weather Code"].map(weather_code_mapping)
-    df = df.drop(columns=["Weather Code"])
-
+@metrics.instrument("display.7_day_forecast")
+def display_7_day_forecast(daily):
+    # Built once per fetch and shared, like the hourly figure
+    table = figure_cache.get_or_load(("7-day", daily.version), lambda: build_daily_table(daily), FIGURE_TTL)
     st.markdown("### 7-Day Weather Forecast")
-    df.index= df.index+1
-    st.dataframe(df)
+    st.dataframe(table)
 
 # Function to get sunrise and sunset times
 def get_sunrise_sunset(lat, lon):
-    url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&daily=sunrise,sunset&timezone=auto"
-    response = requests.get(url)
-
-    if response.status_code == 200:
-        return response.json()  # Return the response in JSON format
+    data = cached_forecast(lat, lon, daily=SECTION_VARIABLES["Sunrise/Sunset"]["daily"])
+    if data is not None:
+        return forecast_dict(data)  # Return the response in JSON format
     else:
         st.error("Failed to fetch sunrise and sunset data.")  # Error handling
         return None
 
 
 # Function to display sunrise and sunset times with Streamlit components
-def display_sunrise_sunset(sunrise_sunset_data):
+@metrics.instrument("display.sunrise_sunset")
+def display_sunrise_sunset(daily):
     try:
-        # Extract sunrise and sunset times from the API response
-        sunrise_time = sunrise_sunset_data["daily"]["sunrise"][0]
-        sunset_time = sunrise_sunset_data["daily"]["sunset"][0]
+        # Extract sunrise and sunset times from the daily forecast
+        if daily.sunrise is None or daily.sunset is None:
+            raise KeyError("sunrise" if daily.sunrise is None else "sunset")
+        sunrise_time = daily.sunrise[0]
+        sunset_time = daily.sunset[0]
 
         # Convert the sunrise and sunset times to datetime objects
-        sunrise_time_obj = datetime.fromisoformat(sunrise_time)
-        sunset_time_obj = datetime.fromisoformat(sunset_time)
+        sunrise_time_obj = sunrise_time.astype(datetime)
+        sunset_time_obj = sunset_time.astype(datetime)
 
         # Format the times as strings for display
         sunrise_time_str = sunrise_time_obj.strftime('%I:%M %p')
@@ -274,56 +362,32 @@ def user_login():
     return st.session_state.logged_in, st.session_state.user_email
 
 
-FAV_FILE = "favorites.csv"
-
-# Load favorites from CSV
-def load_favorites():
-    if os.path.exists(FAV_FILE):
-        return pd.read_csv(FAV_FILE)
-    else:
-        return pd.DataFrame(columns=["user", "city"])
-
-# Save favorites to CSV
-def save_favorites(fav_df):
-    fav_df.to_csv(FAV_FILE, index=False)
-
-
+@metrics.instrument("manage_favorites")
 def manage_favorites(city, user):
     """
     Displays favorite city management section inside the sidebar.
     Returns the updated city based on user selection.
     """
 
-     # Load favorites from file into session_state if missing
-    if "favorites_df" not in st.session_state:
-        st.session_state["favorites_df"] = load_favorites()
-
-    df = st.session_state["favorites_df"]
-    user_favorites = df[df["user"] == user]
+    store = get_user_store()
+    user_favorites = store.get_favorites(user)
 
     # Add to Favorites button
     if st.sidebar.button("⭐ Add to Favorites"):
         if city:
-            if city not in user_favorites["city"].values:
+            if city not in user_favorites:
                 if len(user_favorites) < 5:
-                    new_entry = pd.DataFrame([{"user": user, "city": city}])
-                    df = pd.concat([df, new_entry], ignore_index=True)
-                    save_favorites(df)
-                    st.session_state["favorites_df"] = df  # Update session_state
+                    store.add_favorite(user, city)
+                    user_favorites.append(city)
                     st.success(f"'{city}' added to favorites!")
                 else:
                     st.error("❌ You can only save 5 favorite cities!")
             else:
                 st.warning("⚠️ City already in favorites!")
 
-    # Reload user_favorites after possible add/remove
-    df = load_favorites()
-    st.session_state["favorites_df"] = df
-    user_favorites = df[df["user"] == user]
-
     # Show Favorites and actions
-    if not user_favorites.empty:
-        fav_city = st.sidebar.selectbox("⭐ Choose Favorite", user_favorites["city"].tolist())
+    if user_favorites:
+        fav_city = st.sidebar.selectbox("⭐ Choose Favorite", user_favorites)
 
         col1, col2 = st.sidebar.columns(2)
         with col1:
@@ -332,30 +396,135 @@ def manage_favorites(city, user):
                 st.success(f"Loaded favorite: {fav_city}")
         with col2:
             if st.sidebar.button("🗑️ Remove Favorite"):
-                df = df[~((df["user"] == user) & (df["city"] == fav_city))]
-                save_favorites(df)
-                st.session_state["favorites_df"] = df
+                store.remove_favorite(user, fav_city)
                 st.success(f"Removed favorite: {fav_city}")
                 st.rerun()
                 
 
     return city
 
-SETTINGS_FILE = "settings.csv"
-
-def load_settings():
-    if os.path.exists(SETTINGS_FILE):
-        return pd.read_csv(SETTINGS_FILE)
-    else:
-        return pd.DataFrame(columns=["user", "unit", "sections", "forecast_range"])
 
-def save_settings(settings_df):
-    settings_df.to_csv(SETTINGS_FILE, index=False)
+# Dashboard sections in the order they appear on the page
+SECTION_ORDER = ("Current Weather", "Hourly Graph", "Sunrise/Sunset", "7-Day Forecast", "Favorites Overview")
+
+
+# Function to get when forecast data was fetched, in the location's local time
+def last_updated(data):
+    return datetime.fromtimestamp(data["fetched_at"] + data["utc_offset_seconds"], tz=timezone.utc)
+
+
+# Function to say when the data shown was fetched, for use while the weather service is down
+def display_last_updated(data):
+    st.caption(f"⚠️ Weather service unavailable · showing data last updated "
+               f"{last_updated(data):%b %d, %I:%M %p} ({data['timezone']})")
+
+
+# Function to draw one section from the data fetched for it
+def render_section(section, data, unit, hours, lat=None, lon=None, past_hours=0):
+    if isinstance(data, dict) and data.get("stale"):
+        display_last_updated(data)
+    if not data:
+        st.error(f"Failed to retrieve {section.lower()} data.")
+    elif section == "Current Weather":
+        display_current_weather(data["current"], unit)
+    elif section == "Hourly Graph":
+        display_hourly_weather(data["hourly"], unit, hours, lat, lon, past_hours)
+    elif section == "Sunrise/Sunset":
+        display_sunrise_sunset(data["daily"])
+    elif section == "7-Day Forecast":
+        display_7_day_forecast(data["daily"])
+    elif section == "Favorites Overview":
+        overview, problems = data
+        for problem in problems:
+            show_problem(problem)
+        if overview:
+            display_favorites_overview(overview, unit)
+        else:
+            st.error("Failed to retrieve favorites overview data.")
+
+
+# Function to start every fetch the selected sections need at once, then draw each
+# section into its own slot as soon as its data arrives
+async def render_sections_async(lat, lon, unit, selected_sections, hours, favorites=(), past_hours=0):
+    plan = plan_data(selected_sections)
+    fetch_forecast = lat is not None and plan.needs_forecast
+    fetch_favorites = bool(favorites) and "Favorites Overview" in selected_sections
+
+    # Lay out every slot before anything blocks, so the page shows its shape straight away
+    slots = {}
+    for section in SECTION_ORDER:
+        if section in selected_sections and (section in SECTION_VARIABLES and fetch_forecast
+                                             or section == "Favorites Overview" and fetch_favorites):
+            slots[section] = st.empty()
+            slots[section].caption(f"⏳ Loading {section}...")
+
+    jobs = {}  # task -> sections it feeds
+    if fetch_forecast:
+        watch_forecast(lat, lon, **plan.variables())
+        # Cached kinds come back straight away; everything missing shares one request
+        for group in split_cached_kinds(lat, lon, plan):
+            task = asyncio.create_task(cached_forecast_async(lat, lon, unit, **group))
+            jobs[task] = [section for section in selected_sections
+                          if SECTION_VARIABLES.get(section, {}).keys() & group.keys()]
+    if fetch_favorites:
+        # Geocoding the favorites can wait on the rate limiter, so it runs off the loop with the fetch
+        task = asyncio.create_task(asyncio.to_thread(get_favorites_overview, favorites, unit))
+        jobs[task] = ["Favorites Overview"]
+
+    pending = set(jobs)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            for section in jobs[task]:
+                with slots[section].container():
+                    render_section(section, task.result(), unit, hours, lat, lon, past_hours)
+
+
+# Weather sections for the selected city and the favorites overview. The fragment
+# re-renders on its own every REFRESH_INTERVAL from the shared cache, which the
+# background refresher keeps warm, so open tabs no longer rerun the whole script
+# or hit the upstream APIs themselves.
+@st.fragment(run_every=REFRESH_INTERVAL)
+def display_sections(lat, lon, unit, selected_sections, hours, favorites=(), past_hours=0):
+    asyncio.run(render_sections_async(lat, lon, unit, selected_sections, hours, favorites, past_hours))
+
+
+# Function to show this rerun's timings as a waterfall in the sidebar (WEATHER_METRICS=1 and ?debug=1)
+def display_timing_panel(trace, started):
+    with st.sidebar.expander("⏱️ Rerun timings", expanded=True):
+        total = time.perf_counter() - started
+        st.caption(f"Rerun took {total * 1000:.1f} ms across {len(trace)} spans")
+        if not trace:
+            return
+        import plotly.graph_objects as go
+
+        labels = [f"{'· ' * span.depth}{span.name} #{i}" for i, span in enumerate(trace)]
+        fig = go.Figure(go.Bar(
+            y=labels,
+            x=[span.duration * 1000 for span in trace],
+            base=[(span.start - started) * 1000 for span in trace],
+            orientation="h",
+            marker_color=["#2ca02c" if span.cache == "hit" else "#d62728" if span.cache == "miss" else "#1f77b4" for span in trace],
+            customdata=[[span.bytes, span.cache or "-"] for span in trace],
+            hovertemplate="%{x:.2f} ms<br>%{customdata[0]} bytes<br>cache: %{customdata[1]}<extra></extra>",
+        ))
+        fig.update_layout(
+            xaxis=dict(title="ms since rerun start"),
+            yaxis=dict(autorange="reversed"),
+            height=120 + 18 * len(trace),
+            margin=dict(l=0, r=0, t=10, b=0),
+        )
+        st.plotly_chart(fig, use_container_width=True)
 
 
 # Main execution
 def main():
-    city_name, lat, lon = get_current_location()
+    started = time.perf_counter()
+    trace = metrics.start_trace()
+    metrics.start_metrics_server()
+    # With a shared forecast API, that process warms the cache instead
+    if not api_client.API_URL:
+        get_warmer(warm_forecasts).start()
 
     # Set page layout
     st.set_page_config(page_title="Weather Dashboard", layout="centered")
@@ -364,8 +533,6 @@ def main():
     st.markdown("<h1 style='text-align: center;'>Weather Dashboard</h1>", unsafe_allow_html=True)
     st.markdown(f"<h4 style='text-align: center;'>{datetime.now().strftime('%A, %B %d, %Y')}</h4>", unsafe_allow_html=True)
 
-    # Auto-refresh every 10 minutes
-    st_autorefresh(interval=600000, key="auto_refresh")
     
 
     # Sidebar for city search and more features.
@@ -382,33 +549,36 @@ def main():
 
     # You can now use `logged_in` and `user_email` throughout your app
     if logged_in:
-        settings_df = load_settings()
+        store = get_user_store()
 
-        user_settings = settings_df[settings_df["user"] == user_email]
+        # Saved settings are read once per session
+        if "saved_settings" not in st.session_state:
+            st.session_state.saved_settings = store.get_settings(user_email)
+        user_settings = st.session_state.saved_settings
 
         if "unit" not in st.session_state:
-            if not user_settings.empty:
-                st.session_state.unit = user_settings["unit"].iloc[0].lower()
+            if user_settings and user_settings["unit"]:
+                st.session_state.unit = user_settings["unit"].lower()
             else:
                 st.session_state.unit = "fahrenheit"  # Default
         
         st.sidebar.header("🔍 Search City")
-        city = st.sidebar.text_input("Enter city name", city_name)
+        city = st.sidebar.text_input("Enter city name", get_default_city(user_email))
         unit = st.sidebar.selectbox("Select Temperature Unit", ("Fahrenheit", "Celsius"),
-                            index=0 if st.session_state.unit == "fahrenheit" else 1)
+                            index=0 if st.session_state.unit.lower() == "fahrenheit" else 1)
         
         st.session_state.unit = unit
 
         
         if "sections" not in st.session_state:
-            if not user_settings.empty and pd.notna(user_settings["sections"].iloc[0]):
-                st.session_state.sections = user_settings["sections"].iloc[0].split(",")
+            if user_settings and user_settings["sections"] is not None:
+                st.session_state.sections = user_settings["sections"]
             else:
                 st.session_state.sections = ["Current Weather"]
 
         selected_sections = st.sidebar.multiselect(
         "📊 Select Sections to Display:",
-        ["Current Weather", "Hourly Graph", "Sunrise/Sunset", "7-Day Forecast"],
+        ["Current Weather", "Hourly Graph", "Sunrise/Sunset", "7-Day Forecast", "Favorites Overview"],
         default=st.session_state.sections      
         )
         st.session_state.sections = selected_sections
@@ -418,12 +588,18 @@ def main():
         labels = ["12 Hours", "24 Hours", "36 Hours", "48 Hours"]
 
         if "forecast_range" not in st.session_state:
-            if not user_settings.empty and pd.notna(user_settings["forecast_range"].iloc[0]):
-                st.session_state.forecast_range = int(user_settings["forecast_range"].iloc[0])
+            if user_settings and user_settings["forecast_range"] is not None:
+                st.session_state.forecast_range = int(user_settings["forecast_range"])
             else:
                 st.session_state.forecast_range = 12  # default to 12 hours
         default_range = f"{st.session_state.forecast_range} Hours"
 
+        # Recorded hours shown before the forecast, from the local history store
+        past_options = [0, 12, 24, 48, 7 * 24, 30 * 24]
+        past_labels = ["Off", "12 Hours", "24 Hours", "48 Hours", "7 Days", "30 Days"]
+        if "history_range" not in st.session_state:
+            st.session_state.history_range = 24
+
         if "Hourly Graph" in selected_sections:
 
             selected_label = st.sidebar.select_slider(
@@ -438,65 +614,64 @@ def main():
 
             st.session_state.forecast_range = selected_value
 
+            selected_past = st.sidebar.select_slider(
+                "Past Range:",
+                options=past_labels,
+                value=past_labels[past_options.index(st.session_state.history_range)]
+            )
+            st.session_state.history_range = dict(zip(past_labels, past_options))[selected_past]
+
         city = manage_favorites(city, user_email)
 
         st.sidebar.markdown("---")
         st.sidebar.write("⚡ **Powered by Open-Meteo API**")
 
-        # Save all user settings
-        if not user_settings.empty:
-            settings_df.loc[settings_df["user"] == user_email, ["unit", "sections", "forecast_range"]] = [
-                st.session_state.unit,
-                ",".join(st.session_state.sections),
-                st.session_state.forecast_range
-            ]
-        else:
-            new_setting = pd.DataFrame([{
-                "user": user_email,
-                "unit": st.session_state.unit,
-                "sections": ",".join(st.session_state.sections),
-                "forecast_range": st.session_state.forecast_range
-            }])
-            settings_df = pd.concat([settings_df, new_setting], ignore_index=True)
-
-        save_settings(settings_df)
-
-        # Fetch weather data for current location
+        # Save user settings, only when something changed
+        current_settings = {
+            "unit": st.session_state.unit,
+            "sections": list(st.session_state.sections),
+            "forecast_range": st.session_state.forecast_range,
+        }
+        if current_settings != user_settings:
+            store.save_settings(user_email, **current_settings)
+            st.session_state.saved_settings = current_settings
+
+        # Work out what the selected sections need, then fetch only that
         unit = unit.lower()
-        with st.spinner("Fetching weather data..."):
-            weather_data = get_weather(lat, lon, unit)
-            hourly_weather = get_hourly_weather(lat, lon, unit)
+        plan = plan_data(selected_sections)
 
-        if city:
+        lat = lon = None
+        if city and plan.needs_forecast:
             lat, lon, address = get_coordinates(city)
 
             if lat and lon and address:
 
                 st.sidebar.success(f"📍 Selected: {address}")
+            else:
+                lat = lon = None
+                # Offer places other users have found that start the same way
+                suggestions = get_geocoder().suggest(city)
+                if suggestions:
+                    st.sidebar.caption("Did you mean: " + " · ".join(place["display_name"] for place in suggestions))
 
-                weather_data = get_weather(lat, lon, unit)
-                if weather_data and "Current Weather" in selected_sections:
-                    # Display current weather metrics
-                    display_current_weather(weather_data["current"], unit)
-
-                hourly_weather = get_hourly_weather(lat, lon, unit)
-                if hourly_weather and "Hourly Graph" in selected_sections:
-                    # Display hourly weather trends
-                    display_hourly_weather(hourly_weather, unit, selected_value)
-
-                # Fetch and display sunrise and sunset times
-                sunrise_sunset_data = get_sunrise_sunset(lat, lon)
-                if sunrise_sunset_data and "Sunrise/Sunset" in selected_sections :
-                    display_sunrise_sunset(sunrise_sunset_data)
+        favorites = ()
+        if "Favorites Overview" in selected_sections:
+            favorites = tuple(store.get_favorites(user_email))
+            if not favorites:
+                st.info("Add some favorite cities to see them side by side.")
 
-                if "7-Day Forecast" in selected_sections:
-                    display_7_day_forecast(lat, lon, unit)
+        if lat is not None or favorites:
+            display_sections(lat, lon, unit, tuple(selected_sections), st.session_state.forecast_range, favorites,
+                             st.session_state.history_range)
 
 
     # Proceed with weather data, user-specific features, etc.
     else:
         st.info("Please log in to view weather data.")
 
+    if trace is not None and "debug" in st.query_params:
+        display_timing_panel(trace, started)
+
 
 if __name__ == "__main__":
     main()